@@ -0,0 +1,212 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from pathlib import Path
+import io
+import json
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import zipfile
+
+import pandas as pd
+
+from config import logger, PROJECT_PATH
+from processor.extractor.extractor import CollectOperationExtractor
+from processor.transformer.collect_transformer import CollectTransformer
+from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.writer.xlsx_writer import XLSXWriter
+from processor.monitoring.stage_recorder import StageRecorder
+
+
+def parse_arguments():
+    """Parse argument from console"""
+    parser = ArgumentParser(description='Time and profile the collect pipeline on synthetic collect files.')
+    parser.add_argument('--sizes', '-s', type=int, nargs='+', default=[10000, 100000],
+                        help='Numbers of collects to generate, one benchmark run each (10k to 5M).')
+    parser.add_argument('--collects-per-territory', type=int, default=20,
+                        help='Average number of collects of a territory, sets the territory cardinality.')
+    parser.add_argument('--missing-stats-ratio', type=float, default=0.2,
+                        help='Share of collects without item_scraped_count and finish_reason in infos.stats.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data generator.')
+    parser.add_argument('--no-workbook', action='store_true', help='Skip the workbook writing stage.')
+    parser.add_argument('--no-tracemalloc', action='store_true',
+                        help='Only measure time, tracemalloc slows down every stage.')
+    parser.add_argument('--output', '-o', type=Path, default=PROJECT_PATH / 'benchmark_results.json',
+                        help='JSON file where results are written.')
+    return parser.parse_args()
+
+
+class SyntheticCollects:
+    """Generate collect files with the schema of the API exports: one file per day, one collect per territory a day"""
+
+    STATS_TEMPLATE = {
+        "downloader/request_count": 2,
+        "downloader/response_count": 2,
+        "downloader/response_status_count/200": 1,
+        "elapsed_time_seconds": 1.2,
+        "log_count/DEBUG": 29,
+        "log_count/INFO": 17,
+        "response_received_count": 1,
+        "scheduler/dequeued": 2,
+        "scheduler/enqueued": 2,
+    }
+
+    FINISH_REASONS = ['finished'] * 20 + ['closespider_timeout']
+
+    def __init__(self, size, collects_per_territory=20, missing_stats_ratio=0.2, seed=0,
+                 start=datetime(2021, 3, 1)):
+        self.size = size
+        self.days = collects_per_territory
+        self.territory_count = max(size // collects_per_territory, 1)
+        self.missing_stats_ratio = missing_stats_ratio
+        self.random = random.Random(seed)
+        self.start = start
+
+    def write(self, directory):
+        """Write the collects as collect_operation_from_<day>_to_<next day>.json.zip files"""
+        directory = Path(directory)
+        territories = [self.get_territory(index) for index in range(self.territory_count)]
+        collect_id = 0
+        for day in range(self.days):
+            date = self.start + timedelta(days=day)
+            collects = []
+            for territory in territories:
+                if collect_id >= self.size:
+                    break
+                collects.append(self.get_collect(collect_id, territory, day, date))
+                collect_id += 1
+
+            name = f'collect_operation_from_{date:%Y-%m-%d}_to_{date + timedelta(days=1):%Y-%m-%d}.json'
+            with zipfile.ZipFile(directory / f'{name}.zip', 'w', zipfile.ZIP_DEFLATED) as archive:
+                with archive.open(name, 'w') as stream, io.TextIOWrapper(stream, encoding='utf-8') as text:
+                    json.dump(collects, text)
+        return self.territory_count
+
+    def get_territory(self, index):
+        kind = 'FREPCI' if index % 20 == 0 else 'FRCOMM'
+        code = f'{200000000 + index}' if kind == 'FREPCI' else f'{index:05d}'
+        return {
+            'territory_uid': f'{kind}{code}',
+            'website': f'https://www.territory-{index}.fr',
+            # Day from which the collects of the territory stop scraping anything, if ever
+            'stopped_from': self.random.randrange(self.days) if self.random.random() < 0.1 else None,
+            'activity': self.random.choice([0, 1, 5, 50, 500]),
+        }
+
+    def get_collect(self, collect_id, territory, day, date):
+        updated_at = (date + timedelta(hours=1, seconds=self.random.randrange(3600))).isoformat()
+        stats = dict(self.STATS_TEMPLATE)
+        if self.random.random() >= self.missing_stats_ratio:
+            stopped = territory['stopped_from'] is not None and day >= territory['stopped_from']
+            stats['item_scraped_count'] = 0 if stopped else self.random.randint(0, 2 * territory['activity'])
+            stats['finish_reason'] = self.random.choice(self.FINISH_REASONS)
+        return {
+            "collect_uid": f"{date:%d%m%Y}_{collect_id}_cron",
+            "created_at": updated_at,
+            "id": collect_id,
+            "infos": {
+                "collected_urls": [],
+                "stats": stats,
+                "territory_uid": territory['territory_uid'],
+                "triggered_by": "crawler-worker",
+            },
+            "log_url": "FIXME",
+            "status": "success",
+            "territory_uid": territory['territory_uid'],
+            "updated_at": updated_at,
+            "website": territory['website'],
+        }
+
+
+def run(args, size, directory):
+    """Generate size collects in directory, then run every stage of the pipeline on them"""
+    logger.info(f'-------------- Benchmark on {size} collects --------------------')
+    generation_start = time.perf_counter()
+    territory_count = SyntheticCollects(size, args.collects_per_territory, args.missing_stats_ratio,
+                                        args.seed).write(directory)
+    generation_seconds = round(time.perf_counter() - generation_start, 4)
+
+    recorder = StageRecorder(enabled=True, trace_memory=not args.no_tracemalloc)
+    extractor = CollectOperationExtractor(data_path=directory)
+
+    with recorder.stage('retrieve_collects') as stage:
+        stage['rows_out'] = sum(len(batch) for batch in extractor.iter_collect_batches())
+
+    with recorder.stage('load_and_transform') as stage:
+        collects = CollectTransformer().load_and_transform_files(extractor)
+        stage['rows_out'] = len(collects)
+
+    with recorder.stage('filter_insufficient_collects') as stage:
+        sufficient_collects = StoppedCollectDetector.filter_insufficient_collects(collects, 2)
+        stage['rows_out'] = len(sufficient_collects)
+
+    with recorder.stage('get_pairs_with_last_collect') as stage:
+        pairs = StoppedCollectDetector.get_pairs_with_last_collect(sufficient_collects)
+        stage['rows_out'] = len(pairs)
+
+    with recorder.stage('get_processed_pairs') as stage:
+        processed_pairs = StoppedCollectDetector.get_processed_pairs(pairs)
+        stage['rows_out'] = len(processed_pairs)
+
+    with recorder.stage('get_sum_scraped_currently_stopped') as stage:
+        currently_stopped = StoppedCollectDetector.get_sum_scraped_currently_stopped(processed_pairs)
+        stage['rows_out'] = len(currently_stopped)
+
+    with recorder.stage('get_ever_active') as stage:
+        ever_active_uids = StoppedCollectDetector.get_ever_active(currently_stopped)
+        stage['rows_out'] = len(ever_active_uids)
+
+    with recorder.stage('get_candidate') as stage:
+        candidates = StoppedCollectDetector.get_candidate(ever_active_uids, currently_stopped)
+        stage['rows_out'] = len(candidates)
+
+    with recorder.stage('get_candidate_single_pass') as stage:
+        stage['rows_out'] = len(StoppedCollectDetector.get_candidate_single_pass(collects))
+
+    if not args.no_workbook:
+        with recorder.stage('write_workbook') as stage:
+            writer = XLSXWriter(write_only=True)
+            for title, frame in [('load_and_transform', collects), ('get_processed_pairs Python', processed_pairs),
+                                 ('get_candidate Python', candidates)]:
+                writer.add_sheet(title, frame)
+            writer.save(Path(directory) / 'benchmark.xlsx')
+            stage['rows_out'] = len(collects) + len(processed_pairs) + len(candidates)
+
+    return {
+        'size': size,
+        'territories': territory_count,
+        'generation_seconds': generation_seconds,
+        'stages': recorder.records,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    results = {
+        'commit': get_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'tracemalloc': not args.no_tracemalloc,
+        'runs': [],
+    }
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            results['runs'].append(run(args, size, directory))
+
+    args.output.write_text(json.dumps(results, indent=2))
+    logger.info(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    main(args)
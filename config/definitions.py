@@ -8,77 +8,124 @@ class CollectFields:
     finish_reason = 'finish_reason'
     status = 'status'
 
+    # Dtypes of the collects once loaded: repeated strings as categories, counts and ids as 32 bits integers
+    DTYPES = {
+        updated_at: 'datetime64[ns]',
+        website: 'category',
+        territory_uid: 'category',
+        id: 'int32',
+        item_scraped_count: 'int32',
+        finish_reason: 'category',
+        status: 'category',
+    }
+
 
 class SheetParameters:
-    """Define parameters for individual columns in the project's worksheets"""
+    """Define parameters for individual columns in the project's worksheets, dtype being the one of the column once
+    read back from a sheet"""
     class UpdatedAt:
         column = 1
         name = CollectFields.updated_at
         range = "A1:A10000"
         width = 20
+        dtype = 'datetime64[ns]'
 
     class Website:
         column = 2
         name = CollectFields.website
         range = "B1:B10000"
         width = 40
+        dtype = 'object'
 
     class TerritoryUid:
         column = 3
         name = CollectFields.territory_uid
         range = "C1:C10000"
         width = 15
+        dtype = 'object'
 
     class Id:
         column = 4
         name = CollectFields.id
         range = 'D1:D10000'
         width = 8
+        dtype = 'int64'
 
     class ItemScrapedCount:
         column = 5
         name = CollectFields.item_scraped_count
         range = "E1:E10000"
         width = 22
+        dtype = 'int64'
 
     class FinishReason:
         column = 6
         name = CollectFields.finish_reason
         range = "F1:F10000"
         width = 13
+        dtype = 'category'
 
     class Status:
         column = 7
         name = CollectFields.status
         range = "G1:G10000"
         width = 13
+        dtype = 'object'
 
     class UpdatedAtLast:
         column = 8
+        name = 'updated_at_last'
         range = "H1:H10000"
         width = 20
+        dtype = 'datetime64[ns]'
 
     class ItemScrapedCountLast:
         column = 9
+        name = 'item_scraped_count_last'
         range = "I1:I10000"
         width = 22
+        dtype = 'int64'
 
     class Interval:
         column = 10
+        name = 'interval'
         range = "J1:J10000"
         width = 22
+        dtype = 'timedelta64[ns]'
 
     class IsStopped:
         column = 11
+        name = 'is_stopped'
         range = "K1:K10000"
         width = 22
+        dtype = 'bool'
 
     class WasActive:
         column = 12
+        name = 'was_active'
         range = "L1:L10000"
         width = 22
+        dtype = 'bool'
 
     class SumScraped:
         column = 13
+        name = 'sum_scrapped'
         range = "M1:M10000"
         width = 22
+        dtype = 'int64'
+
+    COLUMNS = [
+        UpdatedAt,
+        Website,
+        TerritoryUid,
+        Id,
+        ItemScrapedCount,
+        FinishReason,
+        Status,
+        UpdatedAtLast,
+        ItemScrapedCountLast,
+        Interval,
+        IsStopped,
+        WasActive,
+        SumScraped,
+    ]
@@ -1,14 +1,19 @@
 from argparse import ArgumentParser
+from datetime import timedelta
 from config import logger
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.utils import get_column_letter
-from openpyxl.formula.translate import Translator
 import pandas as pd
 
+from processor.cache.collect_cache import CollectCache
 from processor.extractor.extractor import CollectOperationExtractor
 from processor.transformer.collect_transformer import CollectTransformer
 from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.indicator.incremental_stopped_collect import IncrementalStoppedCollectDetector
+from processor.indicator.partitioned_stopped_collect import PartitionedStoppedCollectDetector
+from processor.writer.xlsx_writer import XLSXWriter
+from processor.writer.frame_writer import FrameWriter
+from processor.writer.xlsx_package_writer import XLSXPackageWriter
+from processor.writer.google_sheet_writer import GoogleSheetWriter
+from processor.monitoring.stage_recorder import StageRecorder
 from config.definitions import SheetParameters
 
 pd.set_option("display.max_columns", 500)
@@ -19,7 +24,114 @@ def parse_arguments():
     """Parse argument from console"""
     parser = ArgumentParser()
     parser.add_argument('--gsheet', '-g', type=str, default='Excel automation project', help='Name of excel file.')
-    return parser.parse_args()
+    parser.add_argument('--batch-size', '-b', type=int, default=CollectOperationExtractor.DEFAULT_BATCH_SIZE,
+                        help='Number of collects decoded at once when reading the data folder.')
+    parser.add_argument('--workers', '-j', type=int, default=1,
+                        help='Number of processes parsing the files of the data folder in parallel.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Parse every file of the data folder again instead of reading unchanged ones from cache.')
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help='Only fold the new files of the data folder into the state saved by the previous run and '
+                             'write the candidates, without the debug sheets.')
+    parser.add_argument('--write-only', '-w', action='store_true',
+                        help='Stream rows to the Excel file as sheets are written instead of keeping the whole '
+                             'workbook in memory.')
+    parser.add_argument('--sheet-workers', '-s', type=int, default=0,
+                        help='Number of processes serializing the sheets while the next ones are computed. '
+                             '0 writes them with openpyxl in the main process.')
+    parser.add_argument('--last-active-day-treshold', '-t', type=int, default=12,
+                        help='Minimal number of days since the furthest inactive collect of a candidate.')
+    parser.add_argument('--horizon-days', type=int, default=None,
+                        help='Only load the collects of that many days before the end of the latest file. Older '
+                             'activity of the territories is kept from a summary of the older files.')
+    parser.add_argument('--partitions', type=int, default=None,
+                        help='Spill the collects into that many partitions by territory and detect the candidates one '
+                             'partition at a time, for histories larger than memory. Implies --compute-only.')
+    parser.add_argument('--compute-only', '-c', action='store_true',
+                        help='Only detect the candidates and write them to --output, without the debug sheets.')
+    parser.add_argument('--output', '-o', type=str, default=None,
+                        help='File where candidates are written, .csv, .parquet or .xlsx. Defaults to the Excel file.')
+    parser.add_argument('--intermediate-sheets', action='store_true',
+                        help='With --compute-only, also write the sheets of the intermediate detector steps.')
+    parser.add_argument('--excel-sheets', action='store_true',
+                        help='With --compute-only, also write the sheets checking the detector steps in Excel.')
+    parser.add_argument('--spreadsheet-id', type=str, default=None,
+                        help='Id of a Google spreadsheet where candidates are exported, only changed rows being sent.')
+    parser.add_argument('--spreadsheet-sheet', type=str, default='get_candidate Python',
+                        help='Sheet of the Google spreadsheet holding the candidates.')
+    parser.add_argument('--sheets-credentials', type=str, default=None,
+                        help='Service account JSON file used to call the Sheets API.')
+    parser.add_argument('--sheets-api-url', type=str, default=GoogleSheetWriter.DEFAULT_API_URL,
+                        help='Base URL of the Sheets API, a local stand-in for instance.')
+    parser.add_argument('--profile', '-p', action='store_true',
+                        help='Log the wall time, CPU time, memory and row counts of every stage.')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='With --profile, also trace Python allocations of every stage, slowing them down.')
+    parser.add_argument('--profile-output', type=str, default=None,
+                        help='With --profile, JSON file where the stage measures are written.')
+    args = parser.parse_args()
+
+    if args.output is None:
+        args.output = f'{args.gsheet}.xlsx'
+    try:
+        FrameWriter.check_path(args.output)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.horizon_days is not None and args.incremental:
+        parser.error('--horizon-days can not be used with --incremental, which already keeps older activity')
+    if args.horizon_days is not None and args.horizon_days < args.last_active_day_treshold:
+        logger.warning('--horizon-days is shorter than --last-active-day-treshold, no candidate can be found')
+    if args.partitions is not None:
+        if args.partitions < 1:
+            parser.error('--partitions must be at least 1')
+        if args.incremental or args.horizon_days is not None:
+            parser.error('--partitions can not be used with --incremental or --horizon-days, which need the whole '
+                         'history in memory')
+        if args.excel_sheets:
+            parser.error('--partitions only writes the candidates and the --intermediate-sheets')
+        args.compute_only = True
+    if (args.intermediate_sheets or args.excel_sheets) and not args.output.lower().endswith('.xlsx'):
+        parser.error('--intermediate-sheets and --excel-sheets need an .xlsx output')
+    return args
+
+
+def add_sheet(writer, recorder, title, dataframe, formulas=()):
+    """Write a sheet of the workbook, measured as a stage of the run"""
+    with recorder.stage(f'write {title}', rows_in=len(dataframe)) as stage:
+        writer.add_sheet(title, dataframe, formulas=formulas)
+        stage['rows_out'] = len(dataframe)
+
+
+def load_collects(args, collect_operations, collect_cache, recorder):
+    """Load and transform the collects, those of the horizon only if any, with the territories active before it"""
+    transformer = CollectTransformer()
+    # Extraction et transformation se font fichier par fichier, elles sont mesurées ensemble
+    with recorder.stage('retrieve_and_transform_collects') as stage:
+        if args.horizon_days is None:
+            collects = transformer.load_and_transform_files(collect_operations, args.batch_size, cache=collect_cache,
+                                                            workers=args.workers)
+        else:
+            activity_cache = None if args.no_cache else CollectCache(CollectTransformer.ACTIVITY_PATH)
+            collects = transformer.load_and_transform_window(collect_operations, args.horizon_days, args.batch_size,
+                                                             cache=collect_cache, workers=args.workers,
+                                                             activity_cache=activity_cache)
+        stage['rows_out'] = len(collects)
+
+    logger.info(f'{len(collects)} collects loaded, {CollectTransformer.get_memory_usage(collects):.1f} MB in memory')
+    if transformer.previously_active is not None:
+        logger.info(f'{len(transformer.previously_active)} territories active before the last {args.horizon_days} days')
+    return collects, transformer.previously_active
+
+
+def export_candidates(args, candidates, recorder):
+    """Send the candidates to the Google spreadsheet, if any"""
+    if args.spreadsheet_id is None:
+        return
+
+    logger.info('-------------- Exporting to Google Sheets ---------------------------------')
+    sheet_writer = GoogleSheetWriter(args.spreadsheet_id, args.spreadsheet_sheet, api_url=args.sheets_api_url,
+                                     credentials_path=args.sheets_credentials)
+    recorder.run('export_candidates', sheet_writer.write, candidates)
 
 
 def print_rows(sheet):
@@ -28,9 +140,31 @@ def print_rows(sheet):
 
 
 def main(args):
+    recorder = StageRecorder(enabled=args.profile, trace_memory=args.profile_memory)
+
     logger.info('-------------- Retrieving collects --------------------')
     collect_operations = CollectOperationExtractor()
-    collect_operations.retrieve_collects()
+    collect_cache = None if args.no_cache else CollectCache()
+
+    if args.incremental:
+        main_incremental(args, collect_operations, collect_cache, recorder)
+    elif args.partitions is not None:
+        main_partitioned(args, collect_operations, collect_cache, recorder)
+    elif args.compute_only and not (args.intermediate_sheets or args.excel_sheets):
+        main_compute_only(args, collect_operations, collect_cache, recorder)
+    else:
+        main_full(args, collect_operations, collect_cache, recorder)
+
+    if args.profile_output:
+        recorder.write_summary(args.profile_output)
+
+
+def main_full(args, collect_operations, collect_cache, recorder):
+    """Write the sheets of the stopped collect detection, every one of them unless in compute only mode"""
+    last_active_day_treshold = args.last_active_day_treshold
+    # En mode compute only, les feuilles intermédiaires et les feuilles Excel sont optionnelles
+    write_intermediate = not args.compute_only or args.intermediate_sheets
+    write_excel = not args.compute_only or args.excel_sheets
 
     # LOAD AND TRANSFORM
     # - Transforme la liste de dictionnaires en dataframe
@@ -38,24 +172,25 @@ def main(args):
     # - Exporte tel quel dans Excel
     logger.info('-------------- Sheet 1 : Load and transform --------------------')
 
-    structured_collects = CollectTransformer().load_and_transform(collect_operations.collect_data)
+    structured_collects, previously_active = load_collects(args, collect_operations, collect_cache, recorder)
 
-    workbook = Workbook()
-    sheet1 = workbook.active
-    sheet1.title = "load_and_transform"
-    for row in dataframe_to_rows(structured_collects, index=False, header=True):
-        sheet1.append(row)
+    if args.sheet_workers:
+        writer = XLSXPackageWriter(workers=args.sheet_workers)
+    else:
+        writer = XLSXWriter(write_only=args.write_only)
+    if write_intermediate:
+        add_sheet(writer, recorder, "load_and_transform", structured_collects)
 
     # FILTER INSUFFICIENT COLLECTS
     # - Filtre les territoires ayant au moins 2 collectes
     # - Exporte tel quel dans Excel
     logger.info('-------------- Sheet 2 : Filter insufficient collects --------------------')
 
-    sufficient_collects = StoppedCollectDetector.filter_insufficient_collects(structured_collects, 2)
+    sufficient_collects = recorder.run('filter_insufficient_collects',
+                                       StoppedCollectDetector.filter_insufficient_collects, structured_collects, 2)
 
-    sufficient_collects_sheet = workbook.create_sheet("filter_insufficient_collects")
-    for row in dataframe_to_rows(sufficient_collects, index=False, header=True):
-        sufficient_collects_sheet.append(row)
+    if write_intermediate:
+        add_sheet(writer, recorder, "filter_insufficient_collects", sufficient_collects)
 
     # PAIRS WITH LAST COLLECTS
     # - Cree un dataframe contenant uniquement les dernieres collectes de chaque territoire
@@ -64,11 +199,11 @@ def main(args):
     # - Exporte tel quel dans Excel
     logger.info('-------------- Sheet 3 : Get pairs with last collect --------------------')
 
-    pairs_with_last_collect = StoppedCollectDetector.get_pairs_with_last_collect(sufficient_collects)
+    pairs_with_last_collect = recorder.run('get_pairs_with_last_collect',
+                                           StoppedCollectDetector.get_pairs_with_last_collect, sufficient_collects)
 
-    pairs_with_last_collect_sheet = workbook.create_sheet("get_pairs_with_last_collect")
-    for row in dataframe_to_rows(pairs_with_last_collect, index=False, header=True):
-        pairs_with_last_collect_sheet.append(row)
+    if write_intermediate:
+        add_sheet(writer, recorder, "get_pairs_with_last_collect", pairs_with_last_collect)
 
     # PROCESSED PAIRS WITH EXCEL
     # - Cree 3 nouvelles colonnes dans Excel
@@ -77,137 +212,168 @@ def main(args):
     #   - was active : si item scraped count est supérieur à 9
     logger.info('-------------- Sheet 4 : Get processed pairs Excel --------------------')
 
-    processed_pairs_excel_sheet = workbook.copy_worksheet(pairs_with_last_collect_sheet)
-    processed_pairs_excel_sheet.title = 'get_processed_pairs Excel'
-
-    processed_pairs_excel_sheet['J1'].value = "interval"
-    processed_pairs_excel_sheet['J2'] = "=(H2-A2)"
-    processed_pairs_excel_sheet['K1'].value = "is_stopped"
-    processed_pairs_excel_sheet['K2'] = '=IF(I2=0, "TRUE", "FALSE")'
-    processed_pairs_excel_sheet['L1'].value = "was_active"
-    processed_pairs_excel_sheet['L2'] = '=IF(E2>9, "TRUE", "FALSE")'
-
-    for i in range(2, processed_pairs_excel_sheet.max_row):
-        processed_pairs_excel_sheet[f'J{i}'] = Translator("=(H2-A2)", origin="J2").translate_formula(f'J{i}')
-        processed_pairs_excel_sheet[f'K{i}'] = Translator('=IF(I2=0, "TRUE", "FALSE")', origin="K2").translate_formula(
-            f'K{i}')
-        processed_pairs_excel_sheet[f'L{i}'] = Translator('=IF(E2>9, "TRUE", "FALSE")', origin="L2").translate_formula(
-            f'L{i}')
+    if write_excel:
+        add_sheet(writer, recorder, 'get_processed_pairs Excel', pairs_with_last_collect, formulas=[
+            ("interval", "=(H2-A2)"),
+            ("is_stopped", '=IF(I2=0, "TRUE", "FALSE")'),
+            ("was_active", f'=IF(E2>{StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT}, "TRUE", "FALSE")'),
+        ])
 
     # PROCESSED PAIRS WITH PYTHON
     # - La meme chose mais transformé dans Python
     logger.info('-------------- Sheet 5 : Get processed pairs Python --------------------')
 
-    processed_pairs = StoppedCollectDetector.get_processed_pairs(pairs_with_last_collect)
+    processed_pairs = recorder.run('get_processed_pairs', StoppedCollectDetector.get_processed_pairs,
+                                   pairs_with_last_collect)
     processed_pairs.sort_values(["territory_uid", "updated_at"], inplace=True, ascending=False)
 
-    processed_pairs_python_sheet = workbook.create_sheet("get_processed_pairs Python")
-    for row in dataframe_to_rows(processed_pairs, index=False, header=True):
-        processed_pairs_python_sheet.append(row)
+    if write_intermediate:
+        add_sheet(writer, recorder, "get_processed_pairs Python", processed_pairs)
 
     # SUM SCRAPED ON CURRENTLY STOPPED COLLECTS
     # - Cree une colonne calculant la somme cumulée des item scraped count par territoire
     # - Exporte tel quel dans Excel
     logger.info('-------------- Sheet 6 : Get sum scraped currently stopped --------------------')
 
-    currently_stopped = StoppedCollectDetector.get_sum_scraped_currently_stopped(processed_pairs)
+    currently_stopped = recorder.run('get_sum_scraped_currently_stopped',
+                                     StoppedCollectDetector.get_sum_scraped_currently_stopped, processed_pairs)
 
-    currently_stopped_sheet = workbook.create_sheet('get_sum_scraped_currently_stopped')
-    for row in dataframe_to_rows(currently_stopped, index=False, header=True):
-        currently_stopped_sheet.append(row)
+    if write_intermediate:
+        add_sheet(writer, recorder, 'get_sum_scraped_currently_stopped', currently_stopped)
 
     # EVER ACTIVE EXCEL
     # - Filtre les territoires pour lesquels il y a eu au moins une collecte active (was_active = TRUE)
     logger.info('-------------- Sheet 7 : Get ever active Excel --------------------')
 
-    ever_active_sheet_E = workbook.copy_worksheet(currently_stopped_sheet)
-    ever_active_sheet_E.title = 'get_ever_active Excel'
-
-    # Récupère les territory_uids où la collecte était active (was_active = True)
-    ever_active_rows = []
-    for row in ever_active_sheet_E.iter_rows(min_row=2, max_row=ever_active_sheet_E.max_row, min_col=12, max_col=12):
-        for cell in row:
-            if cell.value == True:
-                ever_active_rows.append(row[0].row)
+    # Les lignes conservées sont calculées en une fois sur les colonnes de la feuille précédente,
+    # puis la feuille filtrée est écrite d'un coup
+    territory_column = currently_stopped.iloc[:, SheetParameters.TerritoryUid.column - 1]
+    was_active_column = currently_stopped.iloc[:, SheetParameters.WasActive.column - 1]
 
-    ever_active_uids = []
-    for active_row in ever_active_rows:
-        ever_active_uids.append(ever_active_sheet_E[f'C{active_row}'].value)
+    # Récupère les territory_uids où la collecte était active (colonne L = TRUE)
+    ever_active_territories = set(territory_column[was_active_column == True])
+    # Avec un horizon, les territoires actifs avant celui-ci le restent
+    ever_active_territories |= set(previously_active if previously_active is not None else [])
+    # Conserve les collectes des territoires qui ont déjà été actifs (colonne C)
+    ever_active_rows = territory_column.isin(ever_active_territories).to_numpy()
 
-    # Supprime les collectes de territoires qui n'ont jamais été actifs
-    for cell in ever_active_sheet_E['C']:
-        if cell.row != 1:
-            if cell.value not in ever_active_uids:
-                ever_active_sheet_E.delete_rows(cell.row)
+    ever_active_excel = currently_stopped[ever_active_rows]
+    if write_excel:
+        add_sheet(writer, recorder, 'get_ever_active Excel', ever_active_excel)
 
     # EVER ACTIVE PYTHON
     # - Filtre les territoires pour lesquels il y a eu au moins une collecte active (was_active = TRUE)
     logger.info('-------------- Sheet 7 : Get ever active Python --------------------')
     
-    ever_active_uids = StoppedCollectDetector.get_ever_active(currently_stopped)
+    ever_active_uids = recorder.run('get_ever_active', StoppedCollectDetector.get_ever_active, currently_stopped,
+                                    previously_active=previously_active, rows_in=len(currently_stopped))
 
-    ever_active_sheet_P = workbook.create_sheet('get_ever_active Python')
-    for row in dataframe_to_rows(ever_active_uids, index=False, header=True):
-        ever_active_sheet_P.append(row)
+    if write_intermediate:
+        add_sheet(writer, recorder, 'get_ever_active Python', ever_active_uids.to_frame())
 
     # GET CANDIDATE EXCEL
+    # - Part des collectes des territoires déjà actifs
+    # - Conserve les lignes où la somme cumulée est nulle (colonne M) et l'interval d'au moins 12 jours (colonne J)
+    # - Garde la collecte inactive la plus ancienne de chaque territoire
     logger.info('-------------- Sheet 8 : Get candidate Excel --------------------')
 
-    get_candidate_sheet_E = workbook.copy_worksheet(ever_active_sheet_P)
-    get_candidate_sheet_E.title = 'get_candidate Excel'
-
-    # Supprime les collectes de territoires qui n'ont jamais été actifs
-    for cell in get_candidate_sheet_E['M']:
-        if cell.row != 1:
-            if cell.value != 0:
-                get_candidate_sheet_E.delete_rows(cell.row)
-
-    # Supprime les lignes où l'interval est inférieur à 12 jours
-    for cell in get_candidate_sheet_E['J']:
-        if cell.row != 1:
-            if cell.value < 12:
-                get_candidate_sheet_E.delete_rows(cell.row)
-                
+    sum_scraped_column = ever_active_excel.iloc[:, SheetParameters.SumScraped.column - 1]
+    interval_column = ever_active_excel.iloc[:, SheetParameters.Interval.column - 1]
+    candidate_rows = ((sum_scraped_column == 0) & (interval_column >= timedelta(last_active_day_treshold))).to_numpy()
+
+    # Les collectes sont triées par date décroissante, la dernière ligne d'un territoire est la plus ancienne
+    candidates_excel = ever_active_excel[candidate_rows]
+    candidates_excel = candidates_excel[
+        ~candidates_excel.iloc[:, SheetParameters.TerritoryUid.column - 1].duplicated(keep='last').to_numpy()]
+    candidates_excel = candidates_excel.sort_values(SheetParameters.TerritoryUid.name, kind='mergesort')
+    if write_excel:
+        add_sheet(writer, recorder, 'get_candidate Excel', candidates_excel)
+
     # GET CANDIDATE PYTHON
     logger.info('-------------- Sheet 8 : Get candidate Python --------------------')
     
-    candidates = StoppedCollectDetector.get_candidate(ever_active_uids, currently_stopped, last_active_day_treshold=12)
+    # Les lignes filtrées sont celles de currently_stopped, pas les territory_uids passés en premier
+    candidates = recorder.run('get_candidate', StoppedCollectDetector.get_candidate, ever_active_uids,
+                              currently_stopped, last_active_day_treshold=last_active_day_treshold,
+                              rows_in=len(currently_stopped))
     
-    get_candidate_sheet_P = workbook.create_sheet('get_candidate Python')
-    for row in dataframe_to_rows(candidates, index=False, header=True):
-        get_candidate_sheet_P.append(row)
+    add_sheet(writer, recorder, 'get_candidate Python', candidates)
 
     # MISE EN FORME
+    # - Largeur des colonnes et filtre automatique sur chaque feuille
     logger.info('-------------- Saving Excel file ---------------------------------')
-    for sheet in workbook._sheets:
-        sheet.column_dimensions[
-            get_column_letter(SheetParameters.UpdatedAt.column)].width = SheetParameters.UpdatedAt.width
-
-        sheet.column_dimensions[get_column_letter(SheetParameters.Website.column)].width = SheetParameters.Website.width
-        sheet.column_dimensions[
-            get_column_letter(SheetParameters.TerritoryUid.column)].width = SheetParameters.TerritoryUid.width
-        sheet.column_dimensions[get_column_letter(SheetParameters.Id.column)].width = SheetParameters.Id.width
-        sheet.column_dimensions[
-            get_column_letter(SheetParameters.ItemScrapedCount.column)].width = SheetParameters.ItemScrapedCount.width
-        sheet.column_dimensions[
-            get_column_letter(SheetParameters.FinishReason.column)].width = SheetParameters.FinishReason.width
-        sheet.column_dimensions[get_column_letter(SheetParameters.Status.column)].width = SheetParameters.Status.width
-        sheet.column_dimensions[
-            get_column_letter(SheetParameters.UpdatedAtLast.column)].width = SheetParameters.UpdatedAtLast.width
-        sheet.column_dimensions[get_column_letter(
-            SheetParameters.ItemScrapedCountLast.column)].width = SheetParameters.ItemScrapedCountLast.width
-        sheet.column_dimensions[get_column_letter(
-            SheetParameters.Interval.column)].width = SheetParameters.Interval.width
-        sheet.column_dimensions[get_column_letter(
-            SheetParameters.IsStopped.column)].width = SheetParameters.IsStopped.width
-        sheet.column_dimensions[get_column_letter(
-            SheetParameters.WasActive.column)].width = SheetParameters.WasActive.width
-        sheet.column_dimensions[get_column_letter(
-            SheetParameters.SumScraped.column)].width = SheetParameters.SumScraped.width
-
-        sheet.auto_filter.ref = sheet.dimensions
-
-    workbook.save(filename=f'{args.gsheet}.xlsx')
+    recorder.run('save_workbook', writer.save, args.output)
+
+    # EXPORT GOOGLE SHEETS
+    # - Envoie les candidats dans la google sheet, seules les lignes modifiées sont envoyées
+    export_candidates(args, candidates, recorder)
+
+
+def main_compute_only(args, collect_operations, collect_cache, recorder):
+    """Detect the candidates in a single pass and only write them"""
+    logger.info('-------------- Compute only --------------------')
+    collects, previously_active = load_collects(args, collect_operations, collect_cache, recorder)
+
+    candidates = recorder.run('get_candidate_single_pass', StoppedCollectDetector.get_candidate_single_pass,
+                              collects, 2, args.last_active_day_treshold, previously_active)
+    logger.info(f'{len(candidates)} candidates')
+    recorder.run('write_candidates', FrameWriter.write, candidates, args.output, title='get_candidate Python')
+    export_candidates(args, candidates, recorder)
+
+
+def main_partitioned(args, collect_operations, collect_cache, recorder):
+    """Spill the collects into partitions by territory, then detect and write the candidates one partition at a time"""
+    logger.info('-------------- Partitioned detection --------------------')
+    detector = PartitionedStoppedCollectDetector(args.partitions, minimal_collect_count=2,
+                                                 last_active_day_treshold=args.last_active_day_treshold)
+
+    with recorder.stage('spill_collects') as stage:
+        stage['rows_out'] = detector.spill(collect_operations, args.batch_size, cache=collect_cache,
+                                           workers=args.workers)
+
+    # Les feuilles intermédiaires sont écrites au fil des partitions, une feuille ne tient jamais en mémoire
+    writer = XLSXWriter(write_only=True) if args.intermediate_sheets else None
+    partition_candidates = []
+    with recorder.stage('detect_partitions') as stage:
+        for partition, sheets in enumerate(detector.iter_sheets(args.workers, keep_intermediate=writer is not None)):
+            partition_candidates.append(sheets.pop(detector.CANDIDATES_TITLE))
+            for title, dataframe in sheets.items():
+                if partition == 0:
+                    writer.add_sheet(title, dataframe)
+                else:
+                    writer.extend_sheet(title, dataframe)
+        candidates = detector.concat_candidates(partition_candidates)
+        stage['rows_out'] = len(candidates)
+    logger.info(f'{len(candidates)} candidates')
+
+    if writer is None:
+        recorder.run('write_candidates', FrameWriter.write, candidates, args.output, title=detector.CANDIDATES_TITLE)
+    else:
+        add_sheet(writer, recorder, detector.CANDIDATES_TITLE, candidates)
+        recorder.run('save_workbook', writer.save, args.output)
+    export_candidates(args, candidates, recorder)
+
+
+def main_incremental(args, collect_operations, collect_cache, recorder):
+    """Fold the new collects into the per territory state of the previous run and write the candidates"""
+    logger.info('-------------- Incremental detection --------------------')
+    detector = IncrementalStoppedCollectDetector(minimal_collect_count=2,
+                                                 last_active_day_treshold=args.last_active_day_treshold)
+
+    new_files = detector.get_new_files(collect_operations.get_collect_files())
+    logger.info(f'{len(new_files)} new files to fold in')
+    if new_files:
+        with recorder.stage('retrieve_and_transform_collects') as stage:
+            new_collects = CollectTransformer().load_and_transform_files(collect_operations, args.batch_size,
+                                                                         cache=collect_cache, paths=new_files,
+                                                                         workers=args.workers)
+            stage['rows_out'] = len(new_collects)
+        recorder.run('fold', detector.fold, new_collects, new_files)
+        detector.save()
+
+    candidates = detector.get_candidates()
+    recorder.run('write_candidates', FrameWriter.write, candidates, args.output, title='get_candidate Python')
+    export_candidates(args, candidates, recorder)
 
 
 if __name__ == '__main__':
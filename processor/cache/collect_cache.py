@@ -0,0 +1,132 @@
+from hashlib import sha1
+from pathlib import Path
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import logger, PROJECT_PATH
+
+
+class CollectCache:
+    """
+    On-disk cache of the transformed collects, one parquet file per input file.
+
+    Entries are addressed by the digest of the content of the input file, so that a file is parsed again only when it
+    is new or has changed, and a file downloaded again or copied under another name is read from the entry of the
+    first one. A persistent index maps the name, size and modification time of the files to their digest, a file
+    being only hashed when it is not in the index yet. Entries of files that are gone or have changed are evicted.
+    """
+    DEFAULT_PATH = PROJECT_PATH / 'cache' / 'collects'
+
+    INDEX_NAME = 'index.json'
+
+    HASH_CHUNK_SIZE = 1024 ** 2
+
+    # Parquet metadata key restoring category values that are not strings (finish_reason defaults to 0)
+    METADATA_KEY = b'collect_cache_categories'
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.logger = logger
+
+        index_path = self.path / self.INDEX_NAME
+        self.index = json.loads(index_path.read_text()) if index_path.exists() else {}
+
+    @staticmethod
+    def get_key(path):
+        """Identify an input file by its name, size and modification time"""
+        stat = Path(path).stat()
+        return sha1(f'{Path(path).name}:{stat.st_size}:{stat.st_mtime_ns}'.encode()).hexdigest()
+
+    @classmethod
+    def get_content_digest(cls, path):
+        """Identify an input file by its content, whatever its name and modification time"""
+        digest = sha1()
+        with Path(path).open('rb') as stream:
+            for chunk in iter(lambda: stream.read(cls.HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_digest(self, path):
+        """Content digest of path, only computed if the index doesn't know the file as it is on disk"""
+        key = self.get_key(path)
+        if key not in self.index:
+            self.index[key] = self.get_content_digest(path)
+            self.save_index()
+        return self.index[key]
+
+    def get_entry_path(self, path):
+        return self.path / f'{self.get_digest(path)}.parquet'
+
+    def contains(self, path):
+        return self.get_entry_path(path).exists()
+
+    def get(self, path, build):
+        """Return the cached frame of path, or build it with build() and cache it"""
+        entry_path = self.get_entry_path(path)
+        if entry_path.exists():
+            self.logger.debug(f'Reading {Path(path).name} from cache')
+            return self.read_frame(entry_path)
+
+        frame = build()
+        self.write_frame(frame, entry_path)
+        return frame
+
+    def evict(self, paths):
+        """Remove the entries, and the index keys, that don't belong to any of paths"""
+        kept_keys = {self.get_key(path) for path in paths}
+        kept_entries = {self.get_entry_path(path).name for path in paths}
+        for entry_path in self.path.glob('*.parquet'):
+            if entry_path.name not in kept_entries:
+                self.logger.debug(f'Evicting stale cache entry {entry_path.name}')
+                entry_path.unlink()
+
+        if set(self.index) - kept_keys:
+            self.index = {key: digest for key, digest in self.index.items() if key in kept_keys}
+            self.save_index()
+
+    def save_index(self):
+        # Write then rename, like the entries
+        index_path = self.path / self.INDEX_NAME
+        temporary_path = index_path.with_suffix('.tmp')
+        temporary_path.write_text(json.dumps(self.index))
+        os.replace(temporary_path, index_path)
+
+    @classmethod
+    def write_frame(cls, frame, entry_path):
+        """Write frame as a parquet file, keeping categories that mix strings and other values"""
+        frame = frame.copy()
+        restored_categories = {}
+        for column in frame.columns:
+            if isinstance(frame[column].dtype, pd.CategoricalDtype):
+                categories = frame[column].cat.categories
+                not_strings = [category for category in categories if not isinstance(category, str)]
+                if not_strings and len(not_strings) != len(categories):
+                    # Arrow needs categories of a single type
+                    restored_categories[column] = {str(category): category for category in not_strings}
+                    frame[column] = frame[column].cat.rename_categories(str)
+
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **table.schema.metadata,
+            cls.METADATA_KEY: json.dumps(restored_categories).encode(),
+        })
+
+        # Write then rename so that an interrupted run never leaves a truncated entry
+        temporary_path = entry_path.with_suffix('.tmp')
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, entry_path)
+
+    @classmethod
+    def read_frame(cls, entry_path):
+        table = pq.read_table(entry_path, memory_map=True)
+        frame = table.to_pandas()
+        restored_categories = json.loads(table.schema.metadata.get(cls.METADATA_KEY, b'{}'))
+        for column, categories in restored_categories.items():
+            frame[column] = frame[column].cat.rename_categories(
+                lambda category: categories.get(category, category))
+        return frame
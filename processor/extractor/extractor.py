@@ -1,24 +1,97 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from pathlib import Path
-import json
-import os
+import gzip
+import re
+import zipfile
+
+import ijson
 
 from config import logger, PROJECT_PATH
 
 
 class CollectOperationExtractor:
+    """Read collect operations exported from the API, as plain or compressed json files."""
+    COLLECT_FILE_SUFFIXES = ('.json', '.json.zip', '.json.gz')
+
+    DEFAULT_BATCH_SIZE = 10000
+
+    # Exports of the API are named after the period of their collects
+    FILE_PERIOD_PATTERN = re.compile(r'collect_operation_from_(\d{4}-\d{2}-\d{2})_to_(\d{4}-\d{2}-\d{2})')
 
-    def __init__(self):
+    def __init__(self, data_path=PROJECT_PATH / 'data'):
         self.collect_data = None
+        self.data_path = Path(data_path)
         self.logger = logger
 
     def retrieve_collects(self):
         """Create a list of each collect as a dictionnary"""
         collects = []
-        filenames = os.listdir(Path(PROJECT_PATH / 'data'))
-        for filename in filenames:
-            if filename.endswith('.json'):
-                file = Path(PROJECT_PATH / 'data' / filename)
-                collects += json.load(file.open('r'))
+        for batch in self.iter_collect_batches():
+            collects += batch
 
         self.collect_data = collects
-        return self.collect_data
\ No newline at end of file
+        return self.collect_data
+
+    def get_collect_files(self):
+        """List the collect files of the data folder, sorted by name so that every run reads them in the same order"""
+        return sorted(path for path in self.data_path.iterdir() if path.name.endswith(self.COLLECT_FILE_SUFFIXES))
+
+    def get_window_start(self, horizon_days, paths=None):
+        """Start of the horizon_days days ending with the period of the latest file, None if no file name has a
+        period"""
+        paths = self.get_collect_files() if paths is None else paths
+        ends = [period[1] for period in map(self.get_file_period, paths) if period is not None]
+        return max(ends) - timedelta(horizon_days) if ends else None
+
+    @classmethod
+    def get_file_period(cls, path):
+        """Start and end dates of a collect_operation_from_<start>_to_<end> file, None for any other name"""
+        match = cls.FILE_PERIOD_PATTERN.match(Path(path).name)
+        if match is None:
+            return None
+        return tuple(datetime.strptime(date, '%Y-%m-%d') for date in match.groups())
+
+    @classmethod
+    def is_in_window(cls, path, window_start):
+        """Whether path may hold collects from window_start on, which files without a period always may"""
+        period = cls.get_file_period(path)
+        return window_start is None or period is None or period[1] >= window_start
+
+    def iter_collect_batches(self, batch_size=DEFAULT_BATCH_SIZE):
+        """Yield the collects of every file as lists of at most batch_size dictionnaries"""
+        for path in self.get_collect_files():
+            self.logger.debug(f'Reading collects from {path.name}')
+            yield from self.iter_file_batches(path, batch_size)
+
+    @classmethod
+    def iter_file_batches(cls, path, batch_size=DEFAULT_BATCH_SIZE):
+        """Parse a single file incrementally, so that only one batch of collects is decoded at a time"""
+        with cls.open_collect_file(path) as stream:
+            batch = []
+            for collect in ijson.items(stream, 'item', use_float=True):
+                batch.append(collect)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+    @staticmethod
+    @contextmanager
+    def open_collect_file(path):
+        """Open a .json, .json.zip or .json.gz file as a binary stream, without extracting it on disk"""
+        path = Path(path)
+        if path.name.endswith('.json.zip'):
+            with zipfile.ZipFile(path) as archive:
+                members = [name for name in archive.namelist() if name.endswith('.json')]
+                if len(members) != 1:
+                    raise ValueError(f'{path.name} should contain exactly one json file, found {len(members)}')
+                with archive.open(members[0]) as stream:
+                    yield stream
+        elif path.name.endswith('.json.gz'):
+            with gzip.open(path, 'rb') as stream:
+                yield stream
+        else:
+            with path.open('rb') as stream:
+                yield stream
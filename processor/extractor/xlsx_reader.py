@@ -1,13 +1,18 @@
 from traceback import format_exc
 from pathlib import Path
 from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter, quote_sheetname, range_boundaries
 from pycel.excelcompiler import ExcelCompiler
 import logging
+import pandas as pd
+
+from config.definitions import SheetParameters
 
 
 class MESSAGES:
     CANT_EVALUATE_CELL = ("Couldn't evaluate cell {address}."
                           " Try to load and save xlsx file.")
+    FILE_MODIFIED = "{path} was modified, clearing cached values."
 
 
 class XLSXReader:
@@ -16,23 +21,115 @@ class XLSXReader:
 
     For formulae, tries to get their precomputed values or, if none,
     to evaluate them.
+
+    Each workbook and the formulae calculator are loaded at most once,
+    and cell values are cached until the file is modified on disk.
+
+    In read only mode, only the values saved in the file are read, row
+    by row, without keeping the cells in memory. Formulae are never
+    evaluated: their value is the one saved by Excel, None if the file
+    was never opened and saved in Excel.
     """
 
     # Interface.
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, read_only: bool = False):
         self.__path = path
-        self.__book = load_workbook(self.__path, data_only=False)
+        self.__read_only = read_only
+        self.__book = None
+        self.__load()
 
     def get_cell_value(self, address: str, sheet: str = None):
+        self.__clear_if_modified()
         # If no sheet given, work with active one.
         if sheet is None:
             sheet = self.__book.active.title
 
+        return self.__get_value(self.__book[sheet][address], sheet)
+
+    def get_range_values(self, cell_range: str, sheet: str = None) -> pd.DataFrame:
+        """
+        Return the values of cell_range (e.g. "J2:L10000") as a dataframe
+        indexed by row number, with column letters as columns.
+        """
+        self.__clear_if_modified()
+        if sheet is None:
+            sheet = self.__book.active.title
+
+        min_col, min_row, max_col, max_row = range_boundaries(cell_range)
+        rows = self.__book[sheet].iter_rows(min_row=min_row, max_row=max_row, min_col=min_col, max_col=max_col)
+        values = [[self.__get_value(cell, sheet) for cell in row] for row in rows]
+
+        return pd.DataFrame(values,
+                            index=range(min_row, min_row + len(values)),
+                            columns=[get_column_letter(column) for column in range(min_col, max_col + 1)])
+
+    def get_sheet_values(self, sheet: str = None, header: bool = True) -> pd.DataFrame:
+        """
+        Return every value of a sheet as a dataframe. With header, the
+        first row gives the column names.
+        """
+        self.__clear_if_modified()
+        if sheet is None:
+            sheet = self.__book.active.title
+
+        values = self.get_range_values(self.__book[sheet].dimensions, sheet)
+        if header and not values.empty:
+            values = values.iloc[1:].set_axis(values.iloc[0].tolist(), axis=1)
+        return values
+
+    def read_sheet(self, sheet: str = None) -> pd.DataFrame:
+        """
+        Return a sheet of the report as a dataframe, columns declared in
+        SheetParameters being converted to their dtype.
+        """
+        self.__clear_if_modified()
+        if sheet is None:
+            sheet = self.__book.active.title
+
+        if self.__read_only:
+            rows = self.__book[sheet].iter_rows(values_only=True)
+            header = next(rows, ())
+            values = pd.DataFrame.from_records(rows, columns=header)
+        else:
+            values = self.get_sheet_values(sheet).reset_index(drop=True)
+
+        columns_parameters = {column.name: column for column in SheetParameters.COLUMNS}
+        for name in values.columns:
+            if name in columns_parameters:
+                values[name] = self.__as_dtype(values[name], columns_parameters[name].dtype)
+        return values
+
+    # Private part.
+
+    def __load(self):
+        self.__modified_at = Path(self.__path).stat().st_mtime
+        if self.__book is not None and self.__read_only:
+            # Read only workbooks keep the file open.
+            self.__book.close()
+        self.__book = load_workbook(self.__path, read_only=self.__read_only, data_only=self.__read_only)
+        # Loaded on first need, see __get_precomputed and __compute.
+        self.__book_with_precomputed_values = None
+        self.__formulae_calculator = None
+        # Values of the formula cells, by (sheet, address).
+        self.__values = {}
+
+    def __clear_if_modified(self):
+        if Path(self.__path).stat().st_mtime != self.__modified_at:
+            logging.info(MESSAGES.FILE_MODIFIED.format(path=self.__path))
+            self.__load()
+
+    def __get_value(self, cell, sheet):
         # If cell doesn't contain a formula, return cell value.
-        if not self.__cell_contains_formula(address, sheet):
-            return self.__get_as_is(address, sheet)
+        if cell.data_type != 'f':
+            return cell.value
+
+        address = cell.coordinate
+        if (sheet, address) not in self.__values:
+            self.__values[sheet, address] = self.__evaluate(address, sheet)
+        return self.__values[sheet, address]
 
+    def __evaluate(self, address, sheet):
         # If cell contains formula:
         # If there's precomputed value of the cell, return it.
         precomputed_value = self.__get_precomputed(address, sheet)
@@ -50,19 +147,9 @@ class XLSXReader:
             return None
         return computed_value
 
-    # Private part.
-
-    def __cell_contains_formula(self, address, sheet):
-        cell = self.__book[sheet][address]
-        return cell.data_type == 'f'
-
-    def __get_as_is(self, address, sheet):
-        # Return cell value.
-        return self.__book[sheet][address].value
-
     def __get_precomputed(self, address, sheet):
         # If the sheet is not loaded yet, load it.
-        if not hasattr(self, '__book_with_precomputed_values'):
+        if self.__book_with_precomputed_values is None:
             self.__book_with_precomputed_values = load_workbook(
                 self.__path, data_only=True)
         # Return precomputed value.
@@ -70,9 +157,29 @@ class XLSXReader:
 
     def __compute(self, address, sheet):
         # If the computation engine is not created yet, create it.
-        if not hasattr(self, '__formulae_calculator'):
-            self.__formulae_calculator = ExcelCompiler(self.__path)
+        if self.__formulae_calculator is None:
+            self.__formulae_calculator = ExcelCompiler(filename=str(self.__path))
         # Compute cell value.
-        computation_graph = self.__formulae_calculator.gen_graph(
-            address, sheet=sheet)
-        return computation_graph.evaluate(f"{sheet}!{address}")
\ No newline at end of file
+        return self.__formulae_calculator.evaluate(
+            f"{quote_sheetname(sheet)}!{address}")
+
+    @staticmethod
+    def __as_dtype(values, dtype):
+        # Formulae never evaluated by Excel, nothing to convert.
+        if values.isna().all():
+            return values
+
+        if dtype.startswith('datetime64'):
+            return pd.to_datetime(values)
+        if dtype.startswith('timedelta64'):
+            # Python sheets hold timedeltas, formulae like =(H2-A2) give a number of days.
+            if pd.api.types.is_numeric_dtype(values.infer_objects()):
+                return pd.to_timedelta(values, unit='D')
+            return pd.to_timedelta(values)
+        if dtype == 'bool':
+            # Excel formulae give "TRUE" and "FALSE" strings.
+            return values.map({True: True, False: False, 'TRUE': True, 'FALSE': False})
+        if dtype == 'int64':
+            numbers = pd.to_numeric(values)
+            return numbers.astype(dtype) if numbers.notna().all() else numbers
+        return values.astype(dtype)
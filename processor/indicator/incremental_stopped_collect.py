@@ -0,0 +1,231 @@
+from datetime import timedelta
+from pathlib import Path
+import json
+
+import pandas as pd
+
+from config import logger, PROJECT_PATH
+from config.definitions import CollectFields
+from processor.cache.collect_cache import CollectCache
+from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.transformer.collect_transformer import CollectTransformer
+
+
+class IncrementalStoppedCollectDetector:
+    """
+    Keep between runs the per territory state needed to detect stopped collects, so that a run only folds in the new
+    collects and recomputes the candidates of the territories they touch.
+
+    For each territory, the state holds the number of collects, whether one of them was ever active, the last collect
+    and the first collect of the trailing run of collects where no item was scraped. That first collect is the
+    candidate when the last collect is at least last_active_day_treshold days later.
+
+    Folded collects are also kept, indexed by id. A collect folded again, from exports overlapping each other for
+    instance, is skipped, while its newer version replaces it. Territories given a newer version of a collect or a
+    collect older than their last one are rebuilt from their folded collects, so that candidates are always the same
+    as the StoppedCollectDetector ones.
+    """
+    DEFAULT_PATH = PROJECT_PATH / 'cache' / 'stopped_collects'
+
+    COLLECT_COLUMNS = [
+        CollectFields.updated_at,
+        CollectFields.website,
+        CollectFields.territory_uid,
+        CollectFields.id,
+        CollectFields.item_scraped_count,
+        CollectFields.finish_reason,
+        CollectFields.status,
+    ]
+
+    # Columns of the stopped run first collect, kept in the state next to the territory aggregates
+    RUN_COLUMNS = [column for column in COLLECT_COLUMNS if column != CollectFields.territory_uid]
+
+    # Columns of the folded collects, indexed by id
+    ID_COLUMNS = [column for column in COLLECT_COLUMNS if column != CollectFields.id]
+
+    def __init__(self, minimal_collect_count=2, last_active_day_treshold=12, path=DEFAULT_PATH):
+        self.minimal_collect_count = minimal_collect_count
+        self.last_active_day_treshold = last_active_day_treshold
+        self.path = Path(path)
+        self.logger = logger
+
+        self.state = self.get_empty_state()
+        self.ids = self.get_empty_ids()
+        self.candidates = None
+        self.folded_files = []
+        self.load()
+
+    def get_new_files(self, paths):
+        """Files that were never folded in, or that changed since"""
+        return [path for path in paths if CollectCache.get_key(path) not in self.folded_files]
+
+    def fold(self, collects, paths=()):
+        """Update the state with new collects, then the candidates of the territories they touch"""
+        collects = collects.sort_values([CollectFields.territory_uid, CollectFields.updated_at], kind='mergesort')
+        # The state holds a single row per territory, plain objects are enough
+        collects = collects.astype({
+            column: object for column in collects.columns if isinstance(collects[column].dtype, pd.CategoricalDtype)
+        })
+
+        # Collects already folded with the same or a later date, from exports overlapping each other for instance
+        known_updated_at = self.ids[CollectFields.updated_at].reindex(collects[CollectFields.id]).to_numpy()
+        already_known = collects[CollectFields.updated_at] <= known_updated_at
+        if already_known.any():
+            self.logger.info(f'Skipping {already_known.sum()} collects already folded')
+            collects = collects[~already_known]
+
+        self.folded_files += [CollectCache.get_key(path) for path in paths]
+        if collects.empty:
+            return self.get_candidates()
+
+        # The aggregates of a territory can only be updated with collects following its last one. Territories with an
+        # older collect, or with a newer version of a folded one, are rebuilt from their folded collects instead.
+        known_last = self.state['updated_at_last'].reindex(collects[CollectFields.territory_uid]).to_numpy()
+        needs_rebuild = ((collects[CollectFields.updated_at] <= known_last) |
+                         collects[CollectFields.id].isin(self.ids.index))
+        rebuilt_territories = collects.loc[needs_rebuild, CollectFields.territory_uid].unique()
+        if len(rebuilt_territories):
+            self.logger.info(f'Rebuilding {len(rebuilt_territories)} territories from their folded collects')
+
+        self.ids = pd.concat([
+            self.ids.drop(collects[CollectFields.id], errors='ignore'),
+            collects.set_index(CollectFields.id)[self.ID_COLUMNS],
+        ])
+        rebuilt_collects = self.ids[self.ids[CollectFields.territory_uid].isin(rebuilt_territories)].reset_index()
+        touched = pd.concat([
+            self.get_updated_state(collects[~collects[CollectFields.territory_uid].isin(rebuilt_territories)]),
+            self.get_updated_state(rebuilt_collects.sort_values(
+                [CollectFields.territory_uid, CollectFields.updated_at], kind='mergesort'), self.get_empty_state()),
+        ])
+        self.state = pd.concat([self.state.drop(touched.index, errors='ignore'), touched]).sort_index()
+
+        touched_candidates = self.get_candidates_from_state(touched)
+        self.candidates = pd.concat([
+            self.get_candidates()[lambda x: ~x[CollectFields.territory_uid].isin(touched.index)],
+            touched_candidates,
+        ]).sort_values(CollectFields.territory_uid, kind='mergesort')
+        return self.get_candidates()
+
+    def get_candidates(self):
+        if self.candidates is None:
+            self.candidates = self.get_candidates_from_state(self.state)
+        return CollectTransformer.apply_dtypes(self.candidates).reset_index(drop=True)
+
+    def get_updated_state(self, collects, state=None):
+        """Aggregate the collects, sorted by territory and date, by territory and combine them with the state, the
+        detector one unless given"""
+        territories = collects[CollectFields.territory_uid]
+        item_scraped_count = collects[CollectFields.item_scraped_count]
+        was_active = item_scraped_count > StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT
+        by_territory = collects.groupby(CollectFields.territory_uid, sort=False, observed=True)
+
+        sum_scrapped = StoppedCollectDetector.get_sum_scraped_until_last(by_territory, item_scraped_count)
+        batch_run_starts = collects[sum_scrapped == 0].drop_duplicates(CollectFields.territory_uid).set_index(
+            CollectFields.territory_uid)[self.RUN_COLUMNS]
+
+        batch = pd.DataFrame({
+            'updated_at_last': by_territory[CollectFields.updated_at].last(),
+            'item_scraped_count_last': by_territory[CollectFields.item_scraped_count].last(),
+            'collect_count': by_territory[CollectFields.id].count(),
+            'ever_active': was_active.groupby(territories, sort=False, observed=True).any(),
+            'item_sum': by_territory[CollectFields.item_scraped_count].sum(),
+        })
+        previous = (self.state if state is None else state).reindex(batch.index)
+
+        # The stopped run of the state goes on when the batch didn't scrape anything
+        continues_run = ((batch['item_sum'] == 0) & (previous['item_scraped_count_last'] == 0)).to_numpy()
+        run_starts = pd.concat([
+            previous.loc[continues_run, self.RUN_COLUMNS],
+            batch_run_starts.reindex(batch.index[~continues_run]),
+        ]).reindex(batch.index)
+
+        updated = run_starts.assign(
+            updated_at_last=batch['updated_at_last'],
+            item_scraped_count_last=batch['item_scraped_count_last'],
+            collect_count=batch['collect_count'] + previous['collect_count'].fillna(0).astype('int64'),
+            ever_active=batch['ever_active'] | previous['ever_active'].fillna(False).astype(bool),
+        )
+        updated.index.name = CollectFields.territory_uid
+        return updated[self.get_empty_state().columns]
+
+    def get_candidates_from_state(self, state):
+        interval = state['updated_at_last'] - state[CollectFields.updated_at]
+        is_candidate = ((state['collect_count'] >= self.minimal_collect_count) & state['ever_active'] &
+                        (state['item_scraped_count_last'] == 0) & interval.notna() &
+                        (interval >= timedelta(self.last_active_day_treshold)))
+
+        candidates = state[is_candidate].reset_index()
+        # Reindexing the state on new territories turns the integer columns of the run start into floats
+        count_dtype = CollectFields.DTYPES[CollectFields.item_scraped_count]
+        return candidates[self.COLLECT_COLUMNS].astype({
+            CollectFields.id: CollectFields.DTYPES[CollectFields.id],
+            CollectFields.item_scraped_count: count_dtype,
+        }).assign(
+            updated_at_last=candidates['updated_at_last'],
+            item_scraped_count_last=candidates['item_scraped_count_last'].astype(count_dtype),
+            interval=interval[is_candidate].to_numpy(),
+            is_stopped=True,
+            was_active=candidates[CollectFields.item_scraped_count] > StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT,
+            sum_scrapped=pd.Series(0, index=candidates.index, dtype=count_dtype),
+        )
+
+    def get_empty_state(self):
+        state = pd.DataFrame({
+            CollectFields.updated_at: pd.Series(dtype='datetime64[ns]'),
+            CollectFields.website: pd.Series(dtype=object),
+            CollectFields.id: pd.Series(dtype='int64'),
+            CollectFields.item_scraped_count: pd.Series(dtype='int64'),
+            CollectFields.finish_reason: pd.Series(dtype=object),
+            CollectFields.status: pd.Series(dtype=object),
+            'updated_at_last': pd.Series(dtype='datetime64[ns]'),
+            'item_scraped_count_last': pd.Series(dtype='int64'),
+            'collect_count': pd.Series(dtype='int64'),
+            'ever_active': pd.Series(dtype=bool),
+        }, index=pd.Index([], name=CollectFields.territory_uid, dtype=object))
+        return state
+
+    def get_empty_ids(self):
+        # Like the state, the folded collects hold plain objects instead of categories
+        dtypes = {column: object if CollectFields.DTYPES[column] == 'category' else CollectFields.DTYPES[column]
+                  for column in self.ID_COLUMNS}
+        ids = pd.DataFrame({
+            column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()
+        }, index=pd.Index([], name=CollectFields.id, dtype=CollectFields.DTYPES[CollectFields.id]))
+        return ids
+
+    def load(self):
+        """Read back the state saved by the previous run, if any"""
+        metadata_path = self.path / 'metadata.json'
+        if not metadata_path.exists():
+            return
+
+        ids_path = self.path / 'ids.parquet'
+        ids = CollectCache.read_frame(ids_path).set_index(CollectFields.id) if ids_path.exists() else None
+        if ids is None or list(ids.columns) != self.ID_COLUMNS:
+            self.logger.warning('The saved state has no folded collects, every file is folded again')
+            return
+
+        metadata = json.loads(metadata_path.read_text())
+        self.folded_files = metadata['folded_files']
+        self.ids = ids.astype(self.get_empty_ids().dtypes.to_dict())
+        self.state = CollectCache.read_frame(self.path / 'state.parquet').set_index(
+            CollectFields.territory_uid).astype({CollectFields.finish_reason: object})
+
+        # Candidates depend on the tresholds, recompute them all if those changed
+        if (metadata['minimal_collect_count'], metadata['last_active_day_treshold']) == (
+                self.minimal_collect_count, self.last_active_day_treshold):
+            self.candidates = CollectCache.read_frame(self.path / 'candidates.parquet').astype(
+                {CollectFields.finish_reason: object})
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        CollectCache.write_frame(
+            self.state.reset_index().astype({CollectFields.finish_reason: 'category'}), self.path / 'state.parquet')
+        CollectCache.write_frame(self.get_candidates(), self.path / 'candidates.parquet')
+        # Repeated strings of the folded collects are stored as categories, as in the collect cache
+        CollectCache.write_frame(CollectTransformer.apply_dtypes(self.ids.reset_index()), self.path / 'ids.parquet')
+        (self.path / 'metadata.json').write_text(json.dumps({
+            'minimal_collect_count': self.minimal_collect_count,
+            'last_active_day_treshold': self.last_active_day_treshold,
+            'folded_files': self.folded_files,
+        }))
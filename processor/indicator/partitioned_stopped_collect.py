@@ -0,0 +1,171 @@
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import shutil
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from config import logger, PROJECT_PATH
+from config.definitions import CollectFields
+from processor.cache.collect_cache import CollectCache
+from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.transformer.collect_transformer import CollectTransformer
+
+
+class PartitionedStoppedCollectDetector:
+    """
+    Detect stopped collects on histories that don't fit in memory. While the data folder is read, batch by batch,
+    collects are hash partitioned by territory uid into parquet spill files, then the detector chain runs on one
+    partition at a time, possibly in parallel processes.
+
+    Every step of the chain is a groupby, merge or sort on the territory uid, so partitions give the same candidates as
+    the whole history, and peak memory is bounded by the largest partition instead of the full dataset.
+    """
+    DEFAULT_PATH = PROJECT_PATH / 'cache' / 'partitions'
+
+    CANDIDATES_TITLE = 'get_candidate Python'
+
+    def __init__(self, partition_count=16, minimal_collect_count=2, last_active_day_treshold=12, path=DEFAULT_PATH):
+        self.partition_count = partition_count
+        self.minimal_collect_count = minimal_collect_count
+        self.last_active_day_treshold = last_active_day_treshold
+        self.path = Path(path)
+        self.logger = logger
+
+    def spill(self, extractor, batch_size=None, cache=None, workers=1):
+        """Partition the collects of the distinct files of the extractor, replacing the spill files of the previous run,
+        and return the number of collects spilled. With several workers, files are partitioned in parallel processes."""
+        batch_size = batch_size or extractor.DEFAULT_BATCH_SIZE
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        for partition in range(self.partition_count):
+            self.get_partition_path(partition).mkdir(parents=True)
+
+        paths = CollectTransformer.get_distinct_files(extractor.get_collect_files(), cache)
+        # Files already flattened by a previous run are read back from the cache instead of being parsed
+        entry_paths = [cache.get_entry_path(path) if cache is not None and cache.contains(path) else None
+                       for path in paths]
+        arguments = [(extractor.iter_file_batches, index, path, batch_size, entry_path)
+                     for index, (path, entry_path) in enumerate(zip(paths, entry_paths))]
+        if workers > 1 and len(paths) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                row_count = sum(executor.map(self.spill_file, *zip(*arguments)))
+        else:
+            row_count = sum(self.spill_file(*argument) for argument in arguments)
+
+        self.logger.info(f'{row_count} collects of {len(paths)} files spilled into {self.partition_count} partitions')
+        return row_count
+
+    def spill_file(self, iter_file_batches, file_index, path, batch_size, entry_path=None):
+        """Partition a single file, one batch of collects at a time, return its number of collects. The collects of a
+        partition are buffered until they reach batch_size, so that parts aren't written for a handful of rows."""
+        if entry_path is not None:
+            frames = [CollectCache.read_frame(entry_path)]
+        else:
+            frames = (CollectTransformer.flatten(batch) for batch in iter_file_batches(path, batch_size))
+
+        buffers = defaultdict(list)
+        part_counts = defaultdict(int)
+        row_count = 0
+        for collects in frames:
+            partitions = self.get_partitions(collects[CollectFields.territory_uid], self.partition_count)
+            for partition, part in collects.groupby(partitions, sort=False):
+                buffers[partition].append(part)
+                if sum(len(buffered) for buffered in buffers[partition]) >= batch_size:
+                    self.write_part(partition, file_index, part_counts[partition], buffers.pop(partition))
+                    part_counts[partition] += 1
+            row_count += len(collects)
+
+        for partition, buffered in buffers.items():
+            self.write_part(partition, file_index, part_counts[partition], buffered)
+        return row_count
+
+    def write_part(self, partition, file_index, part_index, frames):
+        part = CollectTransformer.concat(frames)
+        # A part would otherwise keep the categories of its whole batch, most of them other partitions ones
+        for column in part.columns:
+            if isinstance(part[column].dtype, pd.CategoricalDtype):
+                part[column] = part[column].cat.remove_unused_categories()
+        # Part names keep the order of files and batches, on which deduplication relies
+        part_path = self.get_partition_path(partition) / f'{file_index:05d}-{part_index:05d}.parquet'
+        CollectCache.write_frame(part, part_path)
+
+    @staticmethod
+    def get_partitions(territory_uids, partition_count):
+        """Partition of each territory uid. Unlike hash, crc32 gives the same partitions in every process and run."""
+        codes, uniques = pd.factorize(territory_uids)
+        unique_partitions = np.array([zlib.crc32(str(uid).encode()) % partition_count for uid in uniques],
+                                     dtype='int64')
+        return unique_partitions[codes]
+
+    def get_partition_path(self, partition):
+        return self.path / f'partition-{partition:04d}'
+
+    def read_partition(self, partition):
+        """Collects of a partition, in the order of the files, with a single collect per id. Ids being those of a single
+        territory, their duplicates are all in the same partition."""
+        part_paths = sorted(self.get_partition_path(partition).glob('*.parquet'))
+        collects = CollectTransformer.concat([CollectCache.read_frame(part_path) for part_path in part_paths])
+        return CollectTransformer.deduplicate(collects)
+
+    def detect(self, partition, keep_intermediate=False):
+        """
+        Run the detector chain on a partition. Return the frames of the report sheets by title: only the candidates,
+        computed in a single pass, unless keep_intermediate.
+        """
+        collects = self.read_partition(partition)
+        if not keep_intermediate:
+            return {self.CANDIDATES_TITLE: StoppedCollectDetector.get_candidate_single_pass(
+                collects, self.minimal_collect_count, self.last_active_day_treshold)}
+
+        sufficient_collects = StoppedCollectDetector.filter_insufficient_collects(collects, self.minimal_collect_count)
+        pairs = StoppedCollectDetector.get_pairs_with_last_collect(sufficient_collects)
+        # get_processed_pairs adds its columns to the pairs, whose sheet must not have them
+        processed_pairs = StoppedCollectDetector.get_processed_pairs(pairs.copy())
+        processed_pairs.sort_values([CollectFields.territory_uid, CollectFields.updated_at], inplace=True,
+                                    ascending=False)
+        currently_stopped = StoppedCollectDetector.get_sum_scraped_currently_stopped(processed_pairs)
+        ever_active_uids = StoppedCollectDetector.get_ever_active(currently_stopped)
+        candidates = StoppedCollectDetector.get_candidate(ever_active_uids, currently_stopped,
+                                                          self.last_active_day_treshold)
+        return {
+            'load_and_transform': collects,
+            'filter_insufficient_collects': sufficient_collects,
+            'get_pairs_with_last_collect': pairs,
+            'get_processed_pairs Python': processed_pairs,
+            'get_sum_scraped_currently_stopped': currently_stopped,
+            'get_ever_active Python': ever_active_uids.to_frame(),
+            self.CANDIDATES_TITLE: candidates,
+        }
+
+    def iter_sheets(self, workers=1, keep_intermediate=False):
+        """Yield the sheets of detect for every partition, in order. With several workers, partitions are detected in
+        parallel processes, at most one more than the workers being in flight so that memory stays bounded."""
+        partitions = range(self.partition_count)
+        if workers <= 1:
+            for partition in partitions:
+                yield self.detect(partition, keep_intermediate)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = deque()
+            for partition in partitions:
+                futures.append(executor.submit(self.detect, partition, keep_intermediate))
+                if len(futures) > workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    @staticmethod
+    def concat_candidates(frames):
+        """Candidates of every partition, at most one per territory, sorted by territory as those of the whole
+        history"""
+        candidates = pd.concat(frames, ignore_index=True)
+        # Categories differ from one partition to another, concat falls back to object
+        candidates = CollectTransformer.apply_dtypes(candidates)
+        return candidates.sort_values(CollectFields.territory_uid, kind='mergesort').reset_index(drop=True)
+
+    def get_candidates(self, workers=1):
+        return self.concat_candidates([sheets[self.CANDIDATES_TITLE] for sheets in self.iter_sheets(workers)])
@@ -1,35 +1,76 @@
 from datetime import timedelta
 
+import pandas as pd
+
 from config.definitions import CollectFields
 
 
+class Engines:
+    """Implementations of the detector steps. Both give the same output, apply is kept as the reference."""
+    apply = 'apply'
+    vectorized = 'vectorized'
+
+    ALL = [apply, vectorized]
+
+
 class StoppedCollectDetector:
-    def __init__(self, collects):
-        self.collect_data = self.filter_insufficient_collects(collects, 2)
-        self.pairs = self.get_last_collect_by_territory(self.collect_data)
-        self.processed_pairs = self.get_processed_pairs(self.pairs)
+    # Item scraped count above which a collect is active
+    ACTIVE_ITEM_SCRAPED_COUNT = 9
+
+    def __init__(self, collects, minimal_collect_count=2, last_active_day_treshold=12, engine=Engines.vectorized,
+                 keep_intermediate=False, previously_active=None):
+        """Detect the candidates. Without keep_intermediate, they are computed in a single pass and the intermediate
+        frames, only needed for the debug workbook, are left to None. previously_active are the territory uids known
+        to have been active in collects left out of collects, older ones for instance."""
+        if not keep_intermediate:
+            self.collect_data = self.pairs = self.processed_pairs = None
+            self.currently_stopped = self.ever_active_uids = None
+            self.candidates = self.get_candidate_single_pass(collects, minimal_collect_count, last_active_day_treshold,
+                                                             previously_active)
+            return
+
+        self.collect_data = self.filter_insufficient_collects(collects, minimal_collect_count, engine)
+        self.pairs = self.get_pairs_with_last_collect(self.collect_data)
+        self.processed_pairs = self.get_processed_pairs(self.pairs, engine)
+        self.currently_stopped = self.get_sum_scraped_currently_stopped(self.processed_pairs)
+        self.ever_active_uids = self.get_ever_active(self.currently_stopped, engine, previously_active)
+        self.candidates = self.get_candidate(self.ever_active_uids, self.currently_stopped, last_active_day_treshold)
+
+    STEPS = ['collect_data', 'pairs', 'processed_pairs', 'currently_stopped', 'ever_active_uids', 'candidates']
 
     @staticmethod
-    def filter_insufficient_collects(collect_data, minimal_collect_count):
+    def filter_insufficient_collects(collect_data, minimal_collect_count, engine=Engines.vectorized):
         """Exclude collects from territories where the total number of collect is less than minimal_collect_count."""
-        return collect_data.groupby(
-            CollectFields.territory_uid
-        ).filter(lambda x: x[CollectFields.id].count() >= minimal_collect_count)
+        if engine == Engines.apply:
+            return collect_data.groupby(
+                CollectFields.territory_uid, observed=True
+            ).filter(lambda x: x[CollectFields.id].count() >= minimal_collect_count)
+
+        collect_count = collect_data.groupby(CollectFields.territory_uid, observed=True)[
+            CollectFields.id].transform('count')
+        return collect_data[collect_count >= minimal_collect_count]
 
     @staticmethod
     def get_pairs_with_last_collect(collect_data):
         """Pair each collect with the last one on a given territory"""
-        last_collects = collect_data.loc[collect_data.groupby(['territory_uid'])["updated_at"].idxmax()]
+        last_collects = collect_data.loc[collect_data.groupby(['territory_uid'], observed=True)["updated_at"].idxmax()]
         pairs = collect_data.merge(last_collects, on=[CollectFields.territory_uid], suffixes=('', '_last'))
         pairs.drop(['website_last', 'id_last', 'finish_reason_last', 'status_last'], axis=1, inplace=True)
         return pairs
 
     @staticmethod
-    def get_processed_pairs(pairs):
+    def get_processed_pairs(pairs, engine=Engines.vectorized):
         """Create a dataframe with, for each territory, combine the last collect with all other collects."""
-        pairs["interval"] = pairs.apply(lambda x: x["updated_at_last"] - x["updated_at"], axis=1)
-        pairs["is_stopped"] = pairs.apply(lambda x: x["item_scraped_count_last"] == 0, axis=1)
-        pairs["was_active"] = pairs.apply(lambda x: x["item_scraped_count"] > 9, axis=1)
+        if engine == Engines.apply:
+            pairs["interval"] = pairs.apply(lambda x: x["updated_at_last"] - x["updated_at"], axis=1)
+            pairs["is_stopped"] = pairs.apply(lambda x: x["item_scraped_count_last"] == 0, axis=1)
+            pairs["was_active"] = pairs.apply(
+                lambda x: x["item_scraped_count"] > StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT, axis=1)
+            return pairs
+
+        pairs["interval"] = pairs["updated_at_last"] - pairs["updated_at"]
+        pairs["is_stopped"] = pairs["item_scraped_count_last"] == 0
+        pairs["was_active"] = pairs["item_scraped_count"] > StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT
         return pairs
 
     @staticmethod
@@ -37,14 +78,20 @@ class StoppedCollectDetector:
         """Calculates the cumulative sum of items scraped for each territory where the last collect is stopped"""
         currently_stopped = processed_pairs[processed_pairs["is_stopped"]]
         currently_stopped = currently_stopped.sort_values(["territory_uid", "updated_at"], ascending=False)
-        currently_stopped["sum_scrapped"] = currently_stopped.groupby(["territory_uid"])[
+        currently_stopped["sum_scrapped"] = currently_stopped.groupby(["territory_uid"], observed=True)[
             "item_scraped_count"].cumsum()
         return currently_stopped
 
     @staticmethod
-    def get_ever_active(currently_stopped):
-        """Extracts territorry uids where at least one collect was active."""
-        ever_active = currently_stopped.groupby("territory_uid")["was_active"].agg(lambda x: any(x)).reset_index()
+    def get_ever_active(currently_stopped, engine=Engines.vectorized, previously_active=None):
+        """Extracts territorry uids where at least one collect was active, or that are in previously_active."""
+        if engine == Engines.apply:
+            ever_active = currently_stopped.groupby("territory_uid", observed=True)["was_active"].agg(
+                lambda x: any(x)).reset_index()
+        else:
+            ever_active = currently_stopped.groupby("territory_uid", observed=True)["was_active"].any().reset_index()
+        if previously_active is not None:
+            ever_active["was_active"] |= ever_active["territory_uid"].isin(previously_active)
         ever_active_uids = ever_active[ever_active["was_active"]]["territory_uid"]
         return ever_active_uids
 
@@ -57,4 +104,102 @@ class StoppedCollectDetector:
                                             (currently_stopped["interval"] >= timedelta(last_active_day_treshold))]
 
         # We keep only the furthest inactive collect.
-        return stopped_collect.loc[stopped_collect.groupby(["territory_uid"])["interval"].idxmax()]
\ No newline at end of file
+        return stopped_collect.loc[stopped_collect.groupby(["territory_uid"], observed=True)["interval"].idxmax()]
+
+    @staticmethod
+    def get_sum_scraped_until_last(by_territory, item_scraped_count):
+        """Reverse cumulative sum: items scraped from each collect up to the last one of its territory, given the
+        collects sorted by territory and date grouped by territory and their item scraped count"""
+        by_territory_count = by_territory[CollectFields.item_scraped_count]
+        return by_territory_count.transform('sum') - by_territory_count.cumsum() + item_scraped_count
+
+    @staticmethod
+    def get_candidate_single_pass(collects, minimal_collect_count=2, last_active_day_treshold=12,
+                                  previously_active=None):
+        """Same candidates as the whole chain, from a single sort by territory and date and without building the pairs
+        table: every per territory value is a groupby transform aligned on the collects."""
+        collects = collects.sort_values([CollectFields.territory_uid, CollectFields.updated_at], kind='mergesort')
+        by_territory = collects.groupby(CollectFields.territory_uid, sort=False, observed=True)
+        item_scraped_count = collects[CollectFields.item_scraped_count]
+
+        collect_count = by_territory[CollectFields.id].transform('count')
+        updated_at_last = by_territory[CollectFields.updated_at].transform('last')
+        item_scraped_count_last = by_territory[CollectFields.item_scraped_count].transform('last')
+        sum_scrapped = StoppedCollectDetector.get_sum_scraped_until_last(by_territory, item_scraped_count)
+        was_active = item_scraped_count > StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT
+        ever_active = was_active.groupby(collects[CollectFields.territory_uid], sort=False, observed=True).transform(
+            'any')
+        if previously_active is not None:
+            ever_active |= collects[CollectFields.territory_uid].isin(previously_active)
+        interval = updated_at_last - collects[CollectFields.updated_at]
+
+        is_candidate = ((collect_count >= minimal_collect_count) & (item_scraped_count_last == 0) & ever_active &
+                        (sum_scrapped == 0) & (interval >= timedelta(last_active_day_treshold)))
+
+        candidates = collects[is_candidate].assign(
+            updated_at_last=updated_at_last[is_candidate],
+            item_scraped_count_last=item_scraped_count_last[is_candidate],
+            interval=interval[is_candidate],
+            is_stopped=item_scraped_count_last[is_candidate] == 0,
+            was_active=was_active[is_candidate],
+            sum_scrapped=sum_scrapped[is_candidate],
+        )
+
+        # Collects are sorted by date, the first candidate of a territory is the furthest inactive collect.
+        candidates = candidates[~candidates[CollectFields.territory_uid].duplicated()]
+        return candidates.reset_index(drop=True)
+
+    SWEEP_COLUMNS = ['minimal_collect_count', 'active_item_treshold', 'last_active_day_treshold']
+
+    @staticmethod
+    def sweep_candidates(collects, minimal_collect_counts=(2,), active_item_tresholds=(ACTIVE_ITEM_SCRAPED_COUNT,),
+                         last_active_day_tresholds=(12,)):
+        """
+        Candidates of every combination of the thresholds, as a single frame with one column per threshold followed
+        by the candidate columns, sorted by thresholds then territory.
+
+        Whatever the thresholds, the candidate of a territory can only be the first collect of its trailing run of
+        collects without scraped items. That collect and the per territory aggregates the thresholds apply to, number
+        of collects and highest item scraped count, are computed once from a single sort, then every combination is
+        a filter of them. active_item_treshold is the item scraped count above which a collect is active,
+        ACTIVE_ITEM_SCRAPED_COUNT in the other methods.
+        """
+        collects = collects.sort_values([CollectFields.territory_uid, CollectFields.updated_at], kind='mergesort')
+        by_territory = collects.groupby(CollectFields.territory_uid, sort=False, observed=True)
+        item_scraped_count = collects[CollectFields.item_scraped_count]
+
+        sum_scrapped = StoppedCollectDetector.get_sum_scraped_until_last(by_territory, item_scraped_count)
+        run_starts = collects[sum_scrapped == 0]
+        run_starts = run_starts[~run_starts[CollectFields.territory_uid].duplicated()]
+
+        aggregates = pd.DataFrame({
+            'collect_count': by_territory[CollectFields.id].count(),
+            'max_item_scraped_count': by_territory[CollectFields.item_scraped_count].max(),
+            'updated_at_last': by_territory[CollectFields.updated_at].last(),
+        })
+        run_starts = run_starts.join(aggregates, on=CollectFields.territory_uid).assign(
+            # The run goes up to the last collect, which scraped nothing
+            item_scraped_count_last=lambda x: x[CollectFields.item_scraped_count],
+        )
+        run_starts['interval'] = run_starts['updated_at_last'] - run_starts[CollectFields.updated_at]
+
+        grid = pd.MultiIndex.from_product(
+            [minimal_collect_counts, active_item_tresholds, last_active_day_tresholds],
+            names=StoppedCollectDetector.SWEEP_COLUMNS,
+        ).to_frame(index=False)
+        combinations = grid.merge(run_starts, how='cross')
+
+        is_candidate = ((combinations['collect_count'] >= combinations['minimal_collect_count']) &
+                        (combinations['max_item_scraped_count'] > combinations['active_item_treshold']) &
+                        (combinations['interval'] >= pd.to_timedelta(combinations['last_active_day_treshold'],
+                                                                     unit='D')))
+        candidates = combinations[is_candidate].assign(
+            is_stopped=True,
+            was_active=lambda x: x[CollectFields.item_scraped_count] > x['active_item_treshold'],
+            sum_scrapped=0,
+        )
+        columns = (StoppedCollectDetector.SWEEP_COLUMNS + list(collects.columns) +
+                   ['updated_at_last', 'item_scraped_count_last', 'interval', 'is_stopped', 'was_active',
+                    'sum_scrapped'])
+        return candidates[columns].reset_index(drop=True)
+
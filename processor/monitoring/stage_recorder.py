@@ -0,0 +1,84 @@
+from contextlib import contextmanager
+from pathlib import Path
+import json
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+from config import logger
+
+
+class StageRecorder:
+    """
+    Measure the stages of a run: wall time, CPU time, peak RSS of the process, tracemalloc peak over the stage and
+    row counts in and out. Each stage is logged as a JSON record and kept for the summary.
+
+    When disabled, stages run as plain calls and nothing is measured.
+    """
+
+    def __init__(self, enabled=False, trace_memory=False):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.records = []
+        self.logger = logger
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """Measure the block. The yielded record can be completed, with rows_out for instance."""
+        if not self.enabled:
+            yield {}
+            return
+
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        if self.trace_memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            traced_at_start = tracemalloc.get_traced_memory()[0]
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - wall_start, 4)
+            record['cpu_seconds'] = round(time.process_time() - cpu_start, 4)
+            record['peak_rss_mb'] = self.get_peak_rss()
+            if self.trace_memory:
+                record['traced_peak_delta_mb'] = round(
+                    (tracemalloc.get_traced_memory()[1] - traced_at_start) / 1024 ** 2, 2)
+            self.records.append(record)
+            self.logger.info(json.dumps(record), extra={'stage': record})
+
+    def run(self, name, function, *args, rows_in=None, **kwargs):
+        """Call function as a stage, rows out being the rows of its result and rows in, unless given, the ones of its
+        first argument, when they are frames"""
+        if not self.enabled:
+            return function(*args, **kwargs)
+
+        if rows_in is None and args:
+            rows_in = self.get_rows(args[0])
+        with self.stage(name, rows_in=rows_in) as record:
+            result = function(*args, **kwargs)
+            record['rows_out'] = self.get_rows(result)
+        return result
+
+    def write_summary(self, path):
+        Path(path).write_text(json.dumps(self.records, indent=2))
+        self.logger.info(f'Stage summary written to {path}')
+
+    @staticmethod
+    def get_rows(value):
+        """Number of rows of a dataframe, series or index, None for anything else"""
+        shape = getattr(value, 'shape', None)
+        return shape[0] if shape else None
+
+    @staticmethod
+    def get_peak_rss():
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
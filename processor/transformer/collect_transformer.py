@@ -1,11 +1,14 @@
+from concurrent.futures import ProcessPoolExecutor
 import json
 
 import pandas as pd
 from pandas import DataFrame
 from datetime import datetime
 
-from config import PROJECT_PATH
+from config import logger, PROJECT_PATH
 from config.definitions import CollectFields
+from processor.cache.collect_cache import CollectCache
+from processor.indicator.stopped_collect import StoppedCollectDetector
 
 
 class CollectTransformer:
@@ -20,19 +23,191 @@ class CollectTransformer:
         CollectFields.status,
     ]
 
+    # Fields nested in infos.stats, with their value when the collect has no stats
+    STATS_FIELDS = {
+        CollectFields.item_scraped_count: 0,
+        CollectFields.finish_reason: 0,
+    }
+
     TERRITORIES_INFOS_PATH = PROJECT_PATH / 'metadata' / 'commune_epci_departement.tsv'
 
     DEPARTMENTS_INFOS_PATH = PROJECT_PATH / 'metadata' / 'departements.json'
 
+    # Parquet copy of the territories infos, indexed by territory uid
+    TERRITORIES_INDEX_PATH = PROJECT_PATH / 'cache' / 'territories'
+
+    # Per file summary of the active territories, read instead of the files older than the detection horizon
+    ACTIVITY_PATH = PROJECT_PATH / 'cache' / 'activity'
+
     def __init__(self):
         self.collect_data = None
-        self.departements_infos = self.get_departements_infos()
-        self.territories_infos = self.get_territories_infos()
+        self.previously_active = None
+        # Metadata is only loaded when territories infos are added to the collects
+        self.__departements_infos = None
+        self.__territories_infos = None
+
+    @property
+    def departements_infos(self):
+        if self.__departements_infos is None:
+            self.__departements_infos = self.get_departements_infos()
+        return self.__departements_infos
+
+    @property
+    def territories_infos(self):
+        if self.__territories_infos is None:
+            self.__territories_infos = self.get_territories_infos()
+        return self.__territories_infos
 
     def load_and_transform(self, data):
-        self.collect_data = self.load(data)
-        self.collect_data[CollectFields.updated_at] = pd.to_datetime(self.collect_data[CollectFields.updated_at])
-        return self.transform(self.collect_data)
+        self.collect_data = self.deduplicate(self.flatten(data))
+        return self.collect_data
+
+    def load_and_transform_files(self, extractor, batch_size=None, cache=None, paths=None, workers=1):
+        """Load and transform the files of the extractor, or only paths if given, one by one. With a CollectCache,
+        files that didn't change since the last run are read back from it instead of being parsed. With several
+        workers, files are parsed in parallel processes, each sending back its file as a dataframe.
+
+        Files with the same content as a previous one, exports downloaded twice for instance, are skipped, then
+        collects appearing several times are deduplicated."""
+        batch_size = batch_size or extractor.DEFAULT_BATCH_SIZE
+        all_paths = extractor.get_collect_files()
+        paths = self.get_distinct_files(all_paths if paths is None else paths, cache)
+
+        missing_paths = [path for path in paths if cache is None or not cache.contains(path)]
+        arguments = [(extractor.iter_file_batches, path, batch_size) for path in missing_paths]
+        if workers > 1 and len(missing_paths) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # map keeps the order of the files whatever the order in which workers finish
+                built_frames = list(executor.map(self.flatten_file, *zip(*arguments)))
+        else:
+            built_frames = [self.flatten_file(*argument) for argument in arguments]
+        built_frames = dict(zip(missing_paths, built_frames))
+
+        if cache is None:
+            frames = [built_frames[path] for path in paths]
+        else:
+            frames = [cache.get(path, lambda path=path: built_frames[path]) for path in paths]
+            cache.evict(all_paths)
+
+        self.collect_data = self.deduplicate(self.concat(frames))
+        return self.collect_data
+
+    @staticmethod
+    def get_distinct_files(paths, cache=None):
+        """Keep the first of the files having the same content, hashed through the index of the cache if any"""
+        distinct_paths = {}
+        for path in paths:
+            digest = cache.get_digest(path) if cache is not None else CollectCache.get_content_digest(path)
+            if digest in distinct_paths:
+                logger.info(f'Skipping {path.name}, same content as {distinct_paths[digest].name}')
+            else:
+                distinct_paths[digest] = path
+        return list(distinct_paths.values())
+
+    @staticmethod
+    def deduplicate(collects):
+        """Keep a single collect per id, the last updated one, from the last file on a tie. Order is kept."""
+        is_latest = ~collects.sort_values(CollectFields.updated_at, kind='mergesort').duplicated(
+            CollectFields.id, keep='last')
+        if is_latest.all():
+            return collects
+
+        logger.info(f'Dropping {(~is_latest).sum()} duplicated collects')
+        return collects[is_latest.reindex(collects.index)].reset_index(drop=True)
+
+    def load_and_transform_window(self, extractor, horizon_days, batch_size=None, cache=None, workers=1,
+                                  activity_cache=None):
+        """
+        Load and transform only the collects of the last horizon_days days, the window ending with the period of the
+        latest file. Files whose name tells they end before the window are not parsed, the collects of the other files
+        are filtered on their date.
+
+        The territories that were active before the window are kept in previously_active, from the collects filtered
+        out and from a summary of each older file. With an activity cache, that summary is only built once per file.
+        """
+        all_paths = extractor.get_collect_files()
+        window_start = extractor.get_window_start(horizon_days, all_paths)
+        paths = [path for path in all_paths if extractor.is_in_window(path, window_start)]
+        older_paths = [path for path in all_paths if not extractor.is_in_window(path, window_start)]
+
+        collects = self.load_and_transform_files(extractor, batch_size, cache, paths, workers)
+        previously_active = set()
+        if window_start is not None:
+            in_window = collects[CollectFields.updated_at] >= window_start
+            previously_active.update(self.get_active_territories(collects[~in_window]))
+            collects = collects[in_window].reset_index(drop=True)
+
+        for path in older_paths:
+            build = lambda path=path: self.get_file_activity(extractor, path, batch_size, cache)
+            summary = build() if activity_cache is None else activity_cache.get(path, build)
+            previously_active.update(summary[CollectFields.territory_uid])
+        if activity_cache is not None:
+            activity_cache.evict(all_paths)
+
+        self.collect_data = collects
+        self.previously_active = pd.Index(sorted(previously_active), name=CollectFields.territory_uid, dtype=object)
+        return self.collect_data
+
+    def get_file_activity(self, extractor, path, batch_size=None, cache=None):
+        """Summary of a file: the territories it holds an active collect of"""
+        if cache is not None and cache.contains(path):
+            collects = cache.read_frame(cache.get_entry_path(path))
+        else:
+            collects = self.flatten_file(extractor.iter_file_batches, path, batch_size or extractor.DEFAULT_BATCH_SIZE)
+        return pd.DataFrame({CollectFields.territory_uid: self.get_active_territories(collects)}, dtype=object)
+
+    @classmethod
+    def get_active_territories(cls, collects):
+        """Territory uids with at least one active collect"""
+        active = collects[collects[CollectFields.item_scraped_count] > StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT]
+        return active[CollectFields.territory_uid].astype(object).unique().tolist()
+
+    @classmethod
+    def flatten_file(cls, iter_file_batches, path, batch_size):
+        """Flatten a whole file, iter_file_batches yielding its collects batch by batch"""
+        return cls.concat([cls.flatten(batch) for batch in iter_file_batches(path, batch_size)])
+
+    @classmethod
+    def concat(cls, frames) -> DataFrame:
+        """Concatenate flattened collects"""
+        if not frames:
+            return cls.flatten([])
+
+        collects = pd.concat(frames, ignore_index=True)
+        # Categories differ from one frame to another, concat falls back to object
+        return cls.apply_dtypes(collects)
+
+    @classmethod
+    def flatten(cls, collects) -> DataFrame:
+        """Build the kept columns in a single pass over the collects, pulling item scraped count and finish reason out
+        of the nested infos.stats dictionary. Missing stats get the same defaults as get_items_scraped_count and
+        get_finish_reason."""
+        top_level_fields = [field for field in cls.COLS_TO_KEEP if field not in cls.STATS_FIELDS]
+        columns = {field: [] for field in cls.COLS_TO_KEEP}
+
+        for collect in collects:
+            for field in top_level_fields:
+                columns[field].append(collect.get(field))
+            stats = (collect.get('infos') or {}).get('stats') or {}
+            for field, default in cls.STATS_FIELDS.items():
+                columns[field].append(stats.get(field, default))
+
+        flattened = pd.DataFrame(columns, columns=cls.COLS_TO_KEEP)
+        flattened[CollectFields.updated_at] = pd.to_datetime(flattened[CollectFields.updated_at])
+        flattened[CollectFields.item_scraped_count] = flattened[CollectFields.item_scraped_count].fillna(0)
+        return cls.apply_dtypes(flattened)
+
+    @staticmethod
+    def apply_dtypes(collects) -> DataFrame:
+        """Convert the collect columns to the dtypes of CollectFields.DTYPES"""
+        return collects.astype({
+            field: dtype for field, dtype in CollectFields.DTYPES.items() if field in collects.columns
+        })
+
+    @staticmethod
+    def get_memory_usage(collects):
+        """Memory used by collects, in MB"""
+        return collects.memory_usage(deep=True).sum() / 1024 ** 2
 
     @staticmethod
     def load(data):
@@ -65,16 +240,16 @@ class CollectTransformer:
         except KeyError:
             return 0
 
-    @staticmethod
-    def add_territories_info(collects):
+    def add_territories_info(self, collects):
         """Keeps the most recent collect when there is more than one by territory that passed the check and renames
         relevant columns"""
+        territory_uids = collects['territory_uid'].astype(str)
+        formatted_collects = collects.join(self.territories_infos, on='territory_uid', how='inner')
 
-        collects['code commune'] = collects['territory_uid'].apply(lambda x: x[6:])
-        formatted_collects = collects.merge(self.territories_infos, on='code commune')
-
-        formatted_collects["departement"] = formatted_collects["territory_uid"].apply(
-            lambda x: self.departements_infos.get(x[6:8]) if x[:6] != 'FREPCI' else None)
+        territory_uids = territory_uids[formatted_collects.index]
+        formatted_collects["departement"] = territory_uids.str[6:8].map(self.departements_infos).where(
+            ~territory_uids.str.startswith('FREPCI'), None)
+        formatted_collects = formatted_collects.reset_index(drop=True)
 
         formatted_collects["Id de l'alerte"] = ""  # Colonne remplie par Eric
         formatted_collects['Date de mise à jour'] = datetime.today().strftime('%Y-%m-%d')
@@ -96,5 +271,24 @@ class CollectTransformer:
 
     @classmethod
     def get_territories_infos(cls):
-        territories_infos = pd.read_csv(cls.TERRITORIES_INFOS_PATH, sep='\t')
-        return territories_infos[['code commune', 'nom commune']]
+        """Codes and names of communes and EPCIs, indexed by territory uid. The index is built from the tsv file once,
+        then read back from its parquet copy as long as the tsv file doesn't change."""
+        index_path = cls.TERRITORIES_INDEX_PATH / f'{CollectCache.get_key(cls.TERRITORIES_INFOS_PATH)}.parquet'
+        if index_path.exists():
+            return pd.read_parquet(index_path)
+
+        # Codes have leading zeros, read them as strings
+        territories_infos = pd.read_csv(cls.TERRITORIES_INFOS_PATH, sep='\t', dtype=str)
+        communes = territories_infos[['code commune', 'nom commune']]
+        epcis = territories_infos[['code epci', 'nom epci']].drop_duplicates().set_axis(
+            ['code commune', 'nom commune'], axis=1)
+        territories_index = pd.concat([
+            communes.assign(territory_uid='FRCOMM' + communes['code commune']),
+            epcis.assign(territory_uid='FREPCI' + epcis['code commune']),
+        ]).drop_duplicates('territory_uid').set_index('territory_uid')
+
+        cls.TERRITORIES_INDEX_PATH.mkdir(parents=True, exist_ok=True)
+        for stale_path in cls.TERRITORIES_INDEX_PATH.glob('*.parquet'):
+            stale_path.unlink()
+        territories_index.to_parquet(index_path)
+        return territories_index
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+from processor.cache.collect_cache import CollectCache
+from processor.writer.xlsx_writer import XLSXWriter
+
+
+class FrameWriter:
+    """
+    Writes a single dataframe, the candidates of a headless run for
+    instance, in the format given by the suffix of the output path:
+    CSV, Parquet or an xlsx workbook with a single sheet.
+    """
+
+    SUFFIXES = ('.csv', '.parquet', '.xlsx')
+
+    @classmethod
+    def check_path(cls, path):
+        """Raise a ValueError if no format matches the suffix of path"""
+        if Path(path).suffix.lower() not in cls.SUFFIXES:
+            raise ValueError(f'Unsupported output {path}, expected one of {", ".join(cls.SUFFIXES)}')
+
+    @classmethod
+    def write(cls, dataframe, path, title='Sheet'):
+        cls.check_path(path)
+        path = Path(path)
+        suffix = path.suffix.lower()
+
+        if suffix == '.csv':
+            dataframe.to_csv(path, index=False)
+        elif suffix == '.parquet':
+            # Categories mixing strings and numbers are not supported by plain to_parquet
+            CollectCache.write_frame(dataframe, path)
+        else:
+            writer = XLSXWriter(write_only=True)
+            writer.add_sheet(title, dataframe)
+            writer.save(path)
@@ -0,0 +1,216 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from numbers import Number
+from threading import Lock
+from urllib.parse import quote
+import random
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+from openpyxl.utils import get_column_letter, quote_sheetname
+
+from config import logger
+
+
+class GoogleSheetWriter:
+    """
+    Writes a dataframe, header included, to a sheet of a Google spreadsheet
+    through the values endpoints of the Sheets API. The sheet is added to
+    the spreadsheet if it doesn't have one with that title yet.
+
+    The current values of the sheet are read first and only the rows that
+    changed are sent, consecutive ones being grouped in a single range.
+    Ranges are sent in a few values:batchUpdate requests, run concurrently,
+    and rows left over from a longer previous table are cleared. Requests
+    answered with a quota or server error are retried with an exponential
+    backoff.
+
+    api_url can point at any server implementing those endpoints, like the
+    local stand-in of sheets_api_stand_in.
+    """
+
+    DEFAULT_API_URL = 'https://sheets.googleapis.com/v4'
+    SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+
+    # Quota and server errors, worth sending the request again
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    # Cells sent by a single values:batchUpdate request
+    MAX_CELLS_PER_REQUEST = 50000
+
+    def __init__(self, spreadsheet_id, title, api_url=DEFAULT_API_URL, credentials_path=None, workers=4,
+                 max_retries=5, backoff=1.0, timeout=60):
+        self.spreadsheet_id = spreadsheet_id
+        self.title = title
+        self.api_url = api_url.rstrip('/')
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.logger = logger
+
+        self.credentials = None
+        self.credentials_lock = Lock()
+        if credentials_path is not None:
+            # Only needed against the real API
+            from google.oauth2.service_account import Credentials
+            self.credentials = Credentials.from_service_account_file(str(credentials_path), scopes=self.SCOPES)
+
+    def write(self, dataframe):
+        """Update the sheet to hold dataframe, return the number of rows sent"""
+        local = self.to_values(dataframe)
+        if self.title not in self.get_titles():
+            self.add_sheet()
+        remote = self.get_values()
+        width = max([len(row) for row in local + remote] or [1])
+        changes = self.get_changes(remote, local, width)
+
+        requests_arguments = [('POST', '/values:batchUpdate', {'valueInputOption': 'RAW', 'data': batch})
+                              for batch in self.get_batches(changes, width)]
+        if len(remote) > len(local):
+            # Rows left over from a longer previous table
+            clear_range = self.get_range(len(local), len(remote), width)
+            requests_arguments.append(('POST', '/values:batchClear', {'ranges': [clear_range]}))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # list raises the first error of the requests, if any
+            list(executor.map(lambda arguments: self.request(arguments[0], arguments[1], json=arguments[2]),
+                              requests_arguments))
+
+        row_count = sum(len(rows) for _, rows in changes)
+        self.logger.info(f'{row_count} changed rows of {self.title} sent in {len(requests_arguments)} requests')
+        return row_count
+
+    def get_titles(self):
+        """Titles of the sheets of the spreadsheet"""
+        response = self.request('GET', '', params={'fields': 'sheets.properties.title'})
+        return [sheet['properties']['title'] for sheet in response.get('sheets', [])]
+
+    def add_sheet(self):
+        self.logger.info(f'Adding the sheet {self.title} to the spreadsheet')
+        self.request('POST', ':batchUpdate', json={'requests': [{'addSheet': {'properties': {'title': self.title}}}]})
+
+    def get_values(self):
+        """Current values of the sheet, as rows of unformatted values"""
+        response = self.request('GET', f'/values/{quote(quote_sheetname(self.title), safe="")}',
+                                params={'valueRenderOption': 'UNFORMATTED_VALUE', 'majorDimension': 'ROWS'})
+        return response.get('values', [])
+
+    @classmethod
+    def get_changes(cls, remote, local, width):
+        """Rows of local that differ from remote, as (index of the first row, rows) of consecutive rows"""
+        changes = []
+        for index, row in enumerate(local):
+            row = cls.pad(row, width)
+            if row == cls.pad(remote[index] if index < len(remote) else [], width):
+                continue
+            if changes and changes[-1][0] + len(changes[-1][1]) == index:
+                changes[-1][1].append(row)
+            else:
+                changes.append((index, [row]))
+        return changes
+
+    def get_batches(self, changes, width):
+        """Value ranges of the changes, in batches of at most MAX_CELLS_PER_REQUEST cells"""
+        rows_per_range = max(self.MAX_CELLS_PER_REQUEST // width, 1)
+        value_ranges = []
+        for first_index, rows in changes:
+            # Longer runs of changed rows are split in several ranges
+            for start in range(0, len(rows), rows_per_range):
+                values = rows[start:start + rows_per_range]
+                value_ranges.append({'range': self.get_range(first_index + start, first_index + start + len(values),
+                                                             width),
+                                     'values': values})
+
+        batches, cell_count = [], 0
+        for value_range in value_ranges:
+            range_cells = len(value_range['values']) * width
+            if not batches or cell_count + range_cells > self.MAX_CELLS_PER_REQUEST:
+                batches.append([])
+                cell_count = 0
+            batches[-1].append(value_range)
+            cell_count += range_cells
+        return batches
+
+    def get_range(self, start, end, width):
+        """A1 range of the rows from index start to end excluded"""
+        return f'{quote_sheetname(self.title)}!A{start + 1}:{get_column_letter(width)}{end}'
+
+    def request(self, method, path, **kwargs):
+        """Send a request to the spreadsheet endpoints, path following the spreadsheet id, retrying quota and server
+        errors"""
+        url = f'{self.api_url}/spreadsheets/{self.spreadsheet_id}{path}'
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = requests.request(method, url, headers=self.get_headers(), timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt == self.max_retries:
+                    raise
+                reason, delay = error, self.backoff * 2 ** attempt
+            else:
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response.json()
+                reason = f'HTTP {response.status_code}'
+                delay = self.get_retry_delay(response.headers.get('Retry-After'), self.backoff * 2 ** attempt)
+
+            # Jitter keeps concurrent requests from retrying all at once
+            delay += random.uniform(0, self.backoff)
+            self.logger.warning(f'{method} {path} failed ({reason}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+    @staticmethod
+    def get_retry_delay(retry_after, default):
+        """Seconds to wait given a Retry-After header, either seconds or an HTTP date, default if missing or invalid"""
+        if retry_after is None:
+            return default
+        try:
+            return max(float(retry_after), 0.)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return default
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.)
+
+    def get_headers(self):
+        if self.credentials is None:
+            return {}
+        with self.credentials_lock:
+            if not self.credentials.valid:
+                from google.auth.transport.requests import Request
+                self.credentials.refresh(Request())
+            return {'Authorization': f'Bearer {self.credentials.token}'}
+
+    @classmethod
+    def to_values(cls, dataframe):
+        """Header and rows of dataframe as JSON values, as the API gives them back"""
+        rows = [[str(column) for column in dataframe.columns]]
+        rows += [[cls.to_value(value) for value in row]
+                 for row in dataframe.astype(object).itertuples(index=False, name=None)]
+        return rows
+
+    @staticmethod
+    def to_value(value):
+        if value is None or (not isinstance(value, str) and pd.isna(value)):
+            return ''
+        if isinstance(value, (bool, np.bool_)):
+            return bool(value)
+        if isinstance(value, Number):
+            return value.item() if isinstance(value, np.generic) else value
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, timedelta):
+            return str(pd.Timedelta(value))
+        return str(value)
+
+    @staticmethod
+    def pad(row, width):
+        """Rows given back by the API stop at their last non empty cell"""
+        return list(row) + [''] * (width - len(row))
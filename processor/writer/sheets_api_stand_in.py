@@ -0,0 +1,196 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import unquote, urlsplit
+import json
+import re
+
+from openpyxl.utils import range_boundaries
+
+from config import logger
+
+
+class SheetsAPIStandIn(ThreadingHTTPServer):
+    """
+    Local, in memory stand-in for the endpoints of the Sheets API used by
+    GoogleSheetWriter: spreadsheets get and batchUpdate with addSheet
+    requests, values get, values:batchUpdate and values:batchClear.
+    Spreadsheets are created on first use, but as with the API, values of
+    a sheet that wasn't added are answered with a 400 error.
+
+    The first fail_first requests are answered with a 429 quota error, so
+    that retries can be checked. Every request is kept in requests.
+    """
+
+    def __init__(self, address=('127.0.0.1', 0), fail_first=0):
+        super().__init__(address, SheetsAPIRequestHandler)
+        # Rows of each sheet, by spreadsheet id then sheet title
+        self.spreadsheets = {}
+        self.requests = []
+        self.fail_first = fail_first
+        self.lock = Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v4'
+
+    def start(self):
+        """Serve in a background thread"""
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_sheet(self, spreadsheet_id, title):
+        """Add an empty sheet, return False if there already is one with that title"""
+        sheets = self.spreadsheets.setdefault(spreadsheet_id, {})
+        if title in sheets:
+            return False
+        sheets[title] = []
+        return True
+
+    def has_sheet(self, spreadsheet_id, title):
+        return title in self.spreadsheets.get(spreadsheet_id, {})
+
+    def get_titles(self, spreadsheet_id):
+        return list(self.spreadsheets.setdefault(spreadsheet_id, {}))
+
+    def get_rows(self, spreadsheet_id, title):
+        """Values of a sheet as the API gives them back: without trailing empty cells and rows"""
+        rows = [list(row) for row in self.spreadsheets.get(spreadsheet_id, {}).get(title, [])]
+        for row in rows:
+            while row and row[-1] == '':
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def update(self, spreadsheet_id, a1_range, values):
+        title, (min_col, min_row, _, _) = self.parse_range(a1_range)
+        rows = self.spreadsheets[spreadsheet_id][title]
+        for row_index, row_values in enumerate(values, min_row - 1):
+            while len(rows) <= row_index:
+                rows.append([])
+            row = rows[row_index]
+            for column_index, value in enumerate(row_values, min_col - 1):
+                while len(row) <= column_index:
+                    row.append('')
+                row[column_index] = value
+        return sum(len(row) for row in values)
+
+    def clear(self, spreadsheet_id, a1_range):
+        title, (min_col, min_row, max_col, max_row) = self.parse_range(a1_range)
+        rows = self.spreadsheets.get(spreadsheet_id, {}).get(title, [])
+        for row in rows[min_row - 1:max_row]:
+            for column_index in range(min_col - 1, min(max_col, len(row))):
+                row[column_index] = ''
+
+    @staticmethod
+    def parse_range(a1_range):
+        """Sheet title and boundaries of a 'Title'!A1:B2 range, the whole sheet if there are no cells"""
+        title, _, cells = a1_range.rpartition('!') if '!' in a1_range else (a1_range, '', '')
+        if title.startswith("'") and title.endswith("'"):
+            title = title[1:-1].replace("''", "'")
+        min_col, min_row, max_col, max_row = range_boundaries(cells) if cells else (None, None, None, None)
+        return title, (min_col or 1, min_row or 1, max_col or 18278, max_row or 10 ** 7)
+
+
+class SheetsAPIRequestHandler(BaseHTTPRequestHandler):
+    PATH_PATTERN = re.compile(r'^/v4/spreadsheets/(?P<spreadsheet_id>[^/:]+)(?P<method>.*)$')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, http_method):
+        server = self.server
+        match = self.PATH_PATTERN.match(urlsplit(self.path).path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+
+        with server.lock:
+            server.requests.append((http_method, self.path, body))
+            if len(server.requests) <= server.fail_first:
+                return self.send_json(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED'}},
+                                      {'Retry-After': '0'})
+            if match is None:
+                return self.send_error_json(404, 'NOT_FOUND', 'Requested entity was not found.')
+
+            spreadsheet_id, method = match['spreadsheet_id'], match['method']
+            if http_method == 'GET' and method == '':
+                return self.send_json(200, {'spreadsheetId': spreadsheet_id, 'sheets': [
+                    {'properties': {'title': title}} for title in server.get_titles(spreadsheet_id)]})
+            if http_method == 'POST' and method == ':batchUpdate':
+                titles = [request['addSheet']['properties']['title'] for request in body.get('requests', [])]
+                existing = [title for title in titles if server.has_sheet(spreadsheet_id, title)]
+                if existing:
+                    return self.send_error_json(400, 'INVALID_ARGUMENT',
+                                                f'A sheet with the name "{existing[0]}" already exists.')
+                for title in titles:
+                    server.add_sheet(spreadsheet_id, title)
+                return self.send_json(200, {'spreadsheetId': spreadsheet_id, 'replies': [
+                    {'addSheet': {'properties': {'title': title}}} for title in titles]})
+
+            # As with the API, values of a sheet that doesn't exist can't be read or written
+            if http_method == 'GET' and method.startswith('/values/'):
+                a1_ranges = [unquote(method[len('/values/'):])]
+            elif http_method == 'POST' and method == '/values:batchUpdate':
+                a1_ranges = [value_range['range'] for value_range in body.get('data', [])]
+            elif http_method == 'POST' and method == '/values:batchClear':
+                a1_ranges = body.get('ranges', [])
+            else:
+                return self.send_error_json(404, 'NOT_FOUND', 'Requested entity was not found.')
+            unknown = [a1_range for a1_range in a1_ranges
+                       if not server.has_sheet(spreadsheet_id, server.parse_range(a1_range)[0])]
+            if unknown:
+                return self.send_error_json(400, 'INVALID_ARGUMENT', f'Unable to parse range: {unknown[0]}')
+
+            if http_method == 'GET':
+                title, _ = server.parse_range(a1_ranges[0])
+                return self.send_json(200, {'range': a1_ranges[0], 'majorDimension': 'ROWS',
+                                            'values': server.get_rows(spreadsheet_id, title)})
+            if method == '/values:batchUpdate':
+                updated_cells = sum(server.update(spreadsheet_id, value_range['range'], value_range['values'])
+                                    for value_range in body.get('data', []))
+                return self.send_json(200, {'spreadsheetId': spreadsheet_id, 'totalUpdatedCells': updated_cells})
+            for a1_range in a1_ranges:
+                server.clear(spreadsheet_id, a1_range)
+            return self.send_json(200, {'spreadsheetId': spreadsheet_id, 'clearedRanges': a1_ranges})
+
+    def send_error_json(self, status, reason, message):
+        return self.send_json(status, {'error': {'code': status, 'status': reason, 'message': message}})
+
+    def send_json(self, status, content, headers=None):
+        payload = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug(f'Sheets API stand-in: {format % args}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Serve a local stand-in of the Sheets API endpoints used by the exports.')
+    parser.add_argument('--port', '-p', type=int, default=8080)
+    args = parser.parse_args()
+
+    stand_in = SheetsAPIStandIn(('127.0.0.1', args.port))
+    logger.info(f'Sheets API stand-in listening on {stand_in.url}')
+    stand_in.serve_forever()
@@ -0,0 +1,248 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from numbers import Number
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from xml.sax.saxutils import escape, quoteattr
+import zipfile
+
+import numpy as np
+import pandas as pd
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import absolute_coordinate, get_column_letter, quote_sheetname
+
+from config.definitions import SheetParameters
+
+
+class XLSXPackageWriter:
+    """
+    Writes dataframes as the sheets of the report, like XLSXWriter, but
+    serializes the XML of each sheet in a pool of worker processes.
+
+    add_sheet only hands the dataframe over to a worker, so that the next
+    sheet can be computed while the previous ones are serialized. save
+    waits for every sheet and assembles the xlsx package, sheets in the
+    order they were added.
+
+    Cells are written the way openpyxl writes them: inline strings,
+    dates and timedeltas as numbers with the openpyxl default formats,
+    formulas without cached value.
+    """
+
+    CHUNK_SIZE = 10000
+
+    # Serial numbers of dates are counted from that day.
+    EPOCH = np.datetime64('1899-12-30', 'ns')
+    DAY = np.timedelta64(1, 'D').astype('timedelta64[ns]').astype('int64')
+
+    # Cell styles of the styles part, see STYLES.
+    DATETIME_STYLE = ' s="1"'
+    TIMEDELTA_STYLE = ' s="2"'
+
+    MAIN_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    RELATIONSHIPS_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    PACKAGE_RELATIONSHIPS_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+    STYLES = (
+        f'{XML_DECLARATION}<styleSheet xmlns="{MAIN_NAMESPACE}">'
+        '<numFmts count="2"><numFmt numFmtId="164" formatCode="yyyy-mm-dd h:mm:ss"/>'
+        '<numFmt numFmtId="165" formatCode="[hh]:mm:ss"/></numFmts>'
+        '<fonts count="1"><font><sz val="11"/><color theme="1"/><name val="Calibri"/><family val="2"/>'
+        '<scheme val="minor"/></font></fonts>'
+        '<fills count="2"><fill><patternFill/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="3"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+        '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+        '</styleSheet>'
+    )
+
+    # Interface.
+
+    def __init__(self, workers=1):
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.directory = TemporaryDirectory(prefix='xlsx_package_')
+        # (title, auto filter reference, future of the sheet XML path) of each sheet, in order
+        self.sheets = []
+
+    def add_sheet(self, title, dataframe, formulas=()):
+        """
+        Queue dataframe, header included, as a new sheet.
+
+        formulas is a list of (header, formula) appended as columns after
+        the dataframe ones, each formula being written for row 2 and
+        translated to the following rows.
+        """
+        path = Path(self.directory.name) / f'sheet{len(self.sheets) + 1}.xml'
+        # The dataframe is only pickled for the worker later on, detector steps may modify it in place meanwhile
+        future = self.executor.submit(self.write_sheet_xml, dataframe.copy(), list(formulas), path)
+        self.sheets.append((title, self.get_reference(dataframe, formulas), future))
+
+    def save(self, filename):
+        try:
+            with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as package:
+                package.writestr('[Content_Types].xml', self.__get_content_types())
+                package.writestr('_rels/.rels', self.__get_package_relationships())
+                package.writestr('xl/workbook.xml', self.__get_workbook())
+                package.writestr('xl/_rels/workbook.xml.rels', self.__get_workbook_relationships())
+                package.writestr('xl/styles.xml', self.STYLES)
+                for index, (_, _, future) in enumerate(self.sheets, 1):
+                    package.write(future.result(), f'xl/worksheets/sheet{index}.xml')
+        finally:
+            self.executor.shutdown()
+            self.directory.cleanup()
+
+    @classmethod
+    def write_sheet_xml(cls, dataframe, formulas, path):
+        """Write the worksheet part of dataframe to path, run in the worker processes"""
+        reference = cls.get_reference(dataframe, formulas)
+        letters = [get_column_letter(column) for column in range(1, len(dataframe.columns) + len(formulas) + 1)]
+        formula_letters = letters[len(dataframe.columns):]
+        # Formulas are tokenized once per column, then only translated for each row.
+        translators = [Translator(formula, origin=f'{letter}2')
+                       for letter, (_, formula) in zip(formula_letters, formulas)]
+
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write(f'{cls.XML_DECLARATION}<worksheet xmlns="{cls.MAIN_NAMESPACE}">'
+                         f'<dimension ref="{reference}"/>{cls.get_columns()}<sheetData>')
+
+            headers = [str(column) for column in dataframe.columns] + [header for header, _ in formulas]
+            stream.write('<row r="1">' + ''.join(
+                cls.get_cell(header, f'{letter}1') for letter, header in zip(letters, headers)) + '</row>')
+
+            for start in range(0, len(dataframe), cls.CHUNK_SIZE):
+                chunk = dataframe.iloc[start:start + cls.CHUNK_SIZE]
+                rows = range(start + 2, start + 2 + len(chunk))
+                columns = [cls.get_column_cells(chunk.iloc[:, index], letter, rows)
+                           for index, letter in enumerate(letters[:len(chunk.columns)])]
+                columns += [[f'<c r="{letter}{row}"><f>{escape(translator.translate_formula(f"{letter}{row}")[1:])}'
+                             f'</f><v></v></c>' for row in rows]
+                            for letter, translator in zip(formula_letters, translators)]
+                stream.writelines(f'<row r="{row}">{"".join(cells)}</row>' for row, cells in zip(rows, zip(*columns)))
+
+            stream.write(f'</sheetData><autoFilter ref="{reference}"/></worksheet>')
+        return path
+
+    @classmethod
+    def get_column_cells(cls, series, letter, rows):
+        """XML of the cells of a column, empty strings standing for missing values"""
+        kind = series.dtype.kind
+        if kind == 'b':
+            return [f'<c r="{letter}{row}" t="b"><v>{int(value)}</v></c>' for row, value in zip(rows, series.tolist())]
+        if kind in 'iuf':
+            return [f'<c r="{letter}{row}" t="n"><v>{value}</v></c>' if value == value else ''
+                    for row, value in zip(rows, series.tolist())]
+        if kind in 'Mm':
+            if kind == 'M':
+                numbers, style = cls.get_date_serials(series), cls.DATETIME_STYLE
+            else:
+                numbers, style = cls.get_timedelta_days(series), cls.TIMEDELTA_STYLE
+            return [f'<c r="{letter}{row}"{style} t="n"><v>{value}</v></c>' if value == value else ''
+                    for row, value in zip(rows, numbers.tolist())]
+        # Categories and objects can mix types, each value is dispatched on its own.
+        return [cls.get_cell(value, f'{letter}{row}') for row, value in zip(rows, series.tolist())]
+
+    @classmethod
+    def get_cell(cls, value, reference):
+        if value is None or pd.isna(value):
+            return ''
+        if isinstance(value, (bool, np.bool_)):
+            return f'<c r="{reference}" t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, Number):
+            return f'<c r="{reference}" t="n"><v>{value}</v></c>'
+        if isinstance(value, datetime):
+            serial = cls.get_date_serials(np.array([value], dtype='datetime64[ns]'))[0]
+            return f'<c r="{reference}"{cls.DATETIME_STYLE} t="n"><v>{serial}</v></c>'
+        if isinstance(value, timedelta):
+            return f'<c r="{reference}"{cls.TIMEDELTA_STYLE} t="n"><v>{value.total_seconds() / 86400}</v></c>'
+
+        value = ILLEGAL_CHARACTERS_RE.sub('', str(value))
+        if value.startswith('='):
+            # Like openpyxl, strings starting with = are formulas
+            return f'<c r="{reference}"><f>{escape(value[1:])}</f><v></v></c>'
+        space = ' xml:space="preserve"' if value != value.strip() else ''
+        return f'<c r="{reference}" t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+
+    @classmethod
+    def get_date_serials(cls, values):
+        """
+        Excel serial numbers of datetimes, computed like openpyxl does:
+        whole days since the epoch plus the fraction of the day, to the
+        microsecond. NaT gives NaN.
+        """
+        values = np.asarray(values, dtype='datetime64[ns]')
+        since_epoch = (values - cls.EPOCH).astype('int64')
+        days = since_epoch // cls.DAY
+        # Excel counts a 1900-02-29 that never was
+        days = np.where((days > 0) & (days <= 60), days - 1, days)
+        microseconds = since_epoch % cls.DAY // 1000
+        serials = days + (microseconds // 10 ** 6 + microseconds % 10 ** 6 / 10 ** 6) / 86400
+        return np.where(np.isnat(values), np.nan, serials)
+
+    @staticmethod
+    def get_timedelta_days(series):
+        return series.dt.total_seconds().to_numpy() / 86400
+
+    @staticmethod
+    def get_reference(dataframe, formulas):
+        """Range of the sheet, the one of its dimension and auto filter"""
+        return f'A1:{get_column_letter(max(len(dataframe.columns) + len(formulas), 1))}{len(dataframe) + 1}'
+
+    @staticmethod
+    def get_columns():
+        return '<cols>' + ''.join(
+            f'<col min="{column.column}" max="{column.column}" width="{column.width}" customWidth="1"/>'
+            for column in SheetParameters.COLUMNS) + '</cols>'
+
+    # Private part.
+
+    def __get_content_types(self):
+        sheets = ''.join(
+            f'<Override PartName="/xl/worksheets/sheet{index}.xml" '
+            f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            for index in range(1, len(self.sheets) + 1))
+        return (
+            f'{self.XML_DECLARATION}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            f'{sheets}</Types>'
+        )
+
+    def __get_package_relationships(self):
+        return (
+            f'{self.XML_DECLARATION}<Relationships xmlns="{self.PACKAGE_RELATIONSHIPS_NAMESPACE}">'
+            f'<Relationship Id="rId1" Type="{self.RELATIONSHIPS_NAMESPACE}/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        )
+
+    def __get_workbook(self):
+        sheets = ''.join(f'<sheet name={quoteattr(title)} sheetId="{index}" r:id="rId{index}"/>'
+                         for index, (title, _, _) in enumerate(self.sheets, 1))
+        # Excel names the range of the auto filter of each sheet
+        names = ''.join(
+            f'<definedName name="_xlnm._FilterDatabase" localSheetId="{index}" hidden="1">'
+            f'{escape(quote_sheetname(title))}!{absolute_coordinate(reference)}</definedName>'
+            for index, (title, reference, _) in enumerate(self.sheets))
+        return (
+            f'{self.XML_DECLARATION}<workbook xmlns="{self.MAIN_NAMESPACE}" xmlns:r="{self.RELATIONSHIPS_NAMESPACE}">'
+            f'<workbookPr/><bookViews><workbookView activeTab="0"/></bookViews><sheets>{sheets}</sheets>'
+            f'{f"<definedNames>{names}</definedNames>" if names else ""}'
+            '<calcPr calcId="124519" fullCalcOnLoad="1"/></workbook>'
+        )
+
+    def __get_workbook_relationships(self):
+        sheets = ''.join(f'<Relationship Id="rId{index}" Type="{self.RELATIONSHIPS_NAMESPACE}/worksheet" '
+                         f'Target="worksheets/sheet{index}.xml"/>' for index in range(1, len(self.sheets) + 1))
+        return (
+            f'{self.XML_DECLARATION}<Relationships xmlns="{self.PACKAGE_RELATIONSHIPS_NAMESPACE}">'
+            f'{sheets}<Relationship Id="rId{len(self.sheets) + 1}" Type="{self.RELATIONSHIPS_NAMESPACE}/styles" '
+            'Target="styles.xml"/></Relationships>'
+        )
@@ -0,0 +1,103 @@
+from openpyxl import Workbook
+from openpyxl.formula.translate import Translator
+from openpyxl.utils import get_column_letter, range_boundaries
+
+from config.definitions import SheetParameters
+
+
+class XLSXWriter:
+    """
+    Writes dataframes as the sheets of the report, with the column widths
+    of SheetParameters and an auto filter on every sheet.
+
+    In write only mode, rows are streamed to a temporary file as soon as
+    they are appended instead of staying in memory as Cell objects until
+    the workbook is saved. Written sheets can't be read or modified
+    anymore (no copy_worksheet, delete_rows...).
+    """
+
+    CHUNK_SIZE = 10000
+
+    # Interface.
+
+    def __init__(self, write_only=False):
+        self.write_only = write_only
+        self.workbook = Workbook(write_only=write_only)
+        if not write_only:
+            # Every sheet is created by add_sheet, drop the default empty one.
+            self.workbook.remove(self.workbook.active)
+
+    def add_sheet(self, title, dataframe, formulas=()):
+        """
+        Write dataframe, header included, in a new sheet.
+
+        formulas is a list of (header, formula) appended as columns after
+        the dataframe ones, each formula being written for row 2 and
+        translated to the following rows.
+        """
+        sheet = self.workbook.create_sheet(title)
+        column_count = len(dataframe.columns) + len(formulas)
+
+        if self.write_only:
+            # Column dimensions are written before the rows, the auto filter when the workbook is saved
+            self.__set_column_widths(sheet)
+            sheet.auto_filter.ref = f'A1:{get_column_letter(max(column_count, 1))}{len(dataframe) + 1}'
+
+        # Formulas are tokenized once per column, then only translated for each row.
+        translators = []
+        for column, (_, formula) in enumerate(formulas, len(dataframe.columns) + 1):
+            letter = get_column_letter(column)
+            translators.append((letter, Translator(formula, origin=f'{letter}2')))
+
+        for row_index, row in enumerate(self.iter_rows(dataframe), 1):
+            if row_index == 1:
+                row += [header for header, _ in formulas]
+            else:
+                row += [translator.translate_formula(f'{letter}{row_index}') for letter, translator in translators]
+            sheet.append(row)
+
+        return sheet
+
+    def extend_sheet(self, title, dataframe):
+        """
+        Append the rows of dataframe, without header, to the sheet written
+        by add_sheet, so that a sheet can be streamed in several parts.
+        """
+        sheet = self.workbook[title]
+        rows = self.iter_rows(dataframe)
+        # The header is already written
+        next(rows)
+        for row in rows:
+            sheet.append(row)
+
+        if self.write_only:
+            # The auto filter is only written when the workbook is saved
+            _, _, max_col, max_row = range_boundaries(sheet.auto_filter.ref)
+            sheet.auto_filter.ref = f'A1:{get_column_letter(max_col)}{max_row + len(dataframe)}'
+        return sheet
+
+    def save(self, filename):
+        if not self.write_only:
+            for sheet in self.workbook.worksheets:
+                self.__set_column_widths(sheet)
+                sheet.auto_filter.ref = sheet.dimensions
+        self.workbook.save(filename=filename)
+
+    @classmethod
+    def iter_rows(cls, dataframe):
+        """Yield the header then the rows of dataframe as lists of python values, None standing for missing ones"""
+        yield [str(column) for column in dataframe.columns]
+        for start in range(0, len(dataframe), cls.CHUNK_SIZE):
+            chunk = dataframe.iloc[start:start + cls.CHUNK_SIZE]
+            columns = [
+                chunk[column].astype(object).where(chunk[column].notna(), None).tolist()
+                for column in chunk.columns
+            ]
+            for row in zip(*columns):
+                yield list(row)
+
+    # Private part.
+
+    def __set_column_widths(self, sheet):
+        for column in SheetParameters.COLUMNS:
+            sheet.column_dimensions[get_column_letter(column.column)].width = column.width
@@ -0,0 +1,11 @@
+import pytest
+
+from processor.extractor.extractor import CollectOperationExtractor
+from processor.transformer.collect_transformer import CollectTransformer
+
+
+@pytest.fixture(scope='session')
+def collects():
+    """Collects of the bundled data folder, with the dtypes of CollectFields.DTYPES. Shared by the tests, which must
+    copy them before any change."""
+    return CollectTransformer().load_and_transform_files(CollectOperationExtractor())
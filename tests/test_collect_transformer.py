@@ -0,0 +1,108 @@
+import copy
+import json
+import shutil
+
+import pandas as pd
+import pytest
+
+from config.definitions import CollectFields
+from processor.cache.collect_cache import CollectCache
+from processor.extractor.extractor import CollectOperationExtractor
+from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.transformer.collect_transformer import CollectTransformer
+
+
+def get_default_dtypes(collects):
+    """Same collects with the dtypes pandas gives them by default: strings as objects and 64 bits integers"""
+    return collects.astype({
+        field: object if dtype == 'category' else 'int64' if dtype == 'int32' else dtype
+        for field, dtype in CollectFields.DTYPES.items()
+    })
+
+
+def test_dtypes_reduce_memory_usage(collects):
+    default_collects = get_default_dtypes(collects)
+    typed_collects = CollectTransformer.apply_dtypes(default_collects)
+
+    before = CollectTransformer.get_memory_usage(default_collects)
+    after = CollectTransformer.get_memory_usage(typed_collects)
+    print(f'{len(collects)} collects: {before:.2f} MB before the dtypes, {after:.2f} MB after')
+    assert after < before / 2
+    pd.testing.assert_frame_equal(typed_collects.astype(object), default_collects.astype(object), check_dtype=False)
+
+
+def test_dtypes_survive_detector_steps(collects):
+    detector = StoppedCollectDetector(collects.copy(), 2, 3, keep_intermediate=True)
+
+    for step in ['collect_data', 'pairs', 'processed_pairs', 'currently_stopped', 'candidates']:
+        frame = getattr(detector, step)
+        for field, dtype in CollectFields.DTYPES.items():
+            if dtype == 'category':
+                assert isinstance(frame[field].dtype, pd.CategoricalDtype), f'{step} {field}'
+            else:
+                assert frame[field].dtype == dtype, f'{step} {field}'
+    assert detector.pairs['item_scraped_count_last'].dtype == CollectFields.DTYPES[CollectFields.item_scraped_count]
+    assert detector.currently_stopped['sum_scrapped'].dtype == 'int32'
+    assert isinstance(detector.ever_active_uids.dtype, pd.CategoricalDtype)
+
+
+def test_workers_give_the_same_collects(collects):
+    extractor = CollectOperationExtractor()
+    single_worker = CollectTransformer().load_and_transform_files(extractor, workers=1)
+    several_workers = CollectTransformer().load_and_transform_files(extractor, workers=3)
+
+    pd.testing.assert_frame_equal(several_workers, single_worker, check_dtype=True, check_categorical=True)
+    pd.testing.assert_frame_equal(single_worker, collects)
+
+
+@pytest.mark.parametrize('horizon_days', [3, 8, 30])
+def test_horizon_matches_filtered_full_load(tmp_path, collects, horizon_days):
+    extractor = CollectOperationExtractor()
+    in_window = collects[CollectFields.updated_at] >= extractor.get_window_start(horizon_days)
+    expected_collects = collects[in_window].reset_index(drop=True)
+    expected_active = sorted(CollectTransformer.get_active_territories(collects[~in_window]))
+
+    # The second load reads the summaries of the older files back from the activity cache
+    activity_cache = CollectCache(tmp_path)
+    for _ in range(2):
+        transformer = CollectTransformer()
+        window_collects = transformer.load_and_transform_window(extractor, horizon_days, activity_cache=activity_cache)
+
+        pd.testing.assert_frame_equal(window_collects, expected_collects, check_categorical=False)
+        assert transformer.previously_active.tolist() == expected_active
+        for last_active_day_treshold in [0, 3]:
+            pd.testing.assert_frame_equal(
+                StoppedCollectDetector.get_candidate_single_pass(window_collects, 2, last_active_day_treshold,
+                                                                 transformer.previously_active),
+                StoppedCollectDetector.get_candidate_single_pass(expected_collects, 2, last_active_day_treshold,
+                                                                 expected_active),
+                check_categorical=False)
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+def test_copies_and_overlapping_exports_are_deduplicated(tmp_path, use_cache):
+    original_path = CollectOperationExtractor().get_collect_files()[0]
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    shutil.copy(original_path, data_path / original_path.name)
+    # The same export downloaded twice
+    shutil.copy(original_path, data_path / original_path.name.replace('.json', ' (1).json'))
+
+    # A later export holding a newer version of the first collect, and a new one
+    raw_collects = next(CollectOperationExtractor.iter_file_batches(original_path))
+    updated, new = copy.deepcopy(raw_collects[0]), copy.deepcopy(raw_collects[1])
+    updated['updated_at'] = '2021-03-04T12:00:00'
+    new['id'], new['updated_at'] = -1, '2021-03-04T13:00:00'
+    (data_path / 'collect_operation_from_2021-03-03_to_2021-03-05.json').write_text(json.dumps([updated, new]))
+
+    cache = CollectCache(tmp_path / 'cache') if use_cache else None
+    collects = CollectTransformer().load_and_transform_files(CollectOperationExtractor(data_path), cache=cache)
+
+    original = CollectTransformer().load_and_transform_files(CollectOperationExtractor(), paths=[original_path])
+    assert len(collects) == len(original) + 1
+    assert collects[CollectFields.id].is_unique
+    updated_collect = collects[collects[CollectFields.id] == updated['id']]
+    assert updated_collect[CollectFields.updated_at].tolist() == [pd.Timestamp('2021-03-04 12:00:00')]
+    # Order of the files is kept, the old version being dropped
+    expected_ids = [collect_id for collect_id in original[CollectFields.id] if collect_id != updated['id']]
+    assert collects[CollectFields.id].tolist() == expected_ids + [updated['id'], -1]
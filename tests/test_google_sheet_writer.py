@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pandas as pd
+import pytest
+import requests
+
+from processor.writer.google_sheet_writer import GoogleSheetWriter
+from processor.writer.sheets_api_stand_in import SheetsAPIStandIn
+
+SPREADSHEET_ID = 'test'
+TITLE = 'get_candidate Python'
+
+
+@pytest.fixture
+def stand_in():
+    with SheetsAPIStandIn() as server:
+        yield server
+
+
+def get_writer(server):
+    return GoogleSheetWriter(SPREADSHEET_ID, TITLE, api_url=server.url, workers=2, backoff=0)
+
+
+def get_frame(row_count=5):
+    return pd.DataFrame({
+        'territory_uid': [f'FRCOMM{index:05d}' for index in range(row_count)],
+        'item_scraped_count': range(row_count),
+        'is_stopped': [index % 2 == 0 for index in range(row_count)],
+    })
+
+
+def get_value_requests(server):
+    return [(path, body) for method, path, body in server.requests if method == 'POST' and '/values:' in path]
+
+
+def test_first_export_adds_the_sheet_and_writes_every_row(stand_in):
+    frame = get_frame()
+
+    assert get_writer(stand_in).write(frame) == len(frame) + 1
+
+    assert stand_in.get_rows(SPREADSHEET_ID, TITLE) == GoogleSheetWriter.to_values(frame)
+    assert any(path.endswith(':batchUpdate') and '/values' not in path for _, path, _ in stand_in.requests)
+
+
+def test_unknown_sheet_values_are_refused(stand_in):
+    writer = get_writer(stand_in)
+
+    with pytest.raises(requests.HTTPError, match='400'):
+        writer.get_values()
+
+
+def test_reexport_sends_no_update(stand_in):
+    get_writer(stand_in).write(get_frame())
+    stand_in.requests.clear()
+
+    assert get_writer(stand_in).write(get_frame()) == 0
+    assert get_value_requests(stand_in) == []
+
+
+def test_changed_row_sends_only_its_range(stand_in):
+    frame = get_frame()
+    get_writer(stand_in).write(frame)
+    stand_in.requests.clear()
+
+    frame.loc[2, 'item_scraped_count'] = 100
+    assert get_writer(stand_in).write(frame) == 1
+
+    [(path, body)] = get_value_requests(stand_in)
+    assert path.endswith('/values:batchUpdate')
+    assert [value_range['range'] for value_range in body['data']] == [f"'{TITLE}'!A4:C4"]
+    assert stand_in.get_rows(SPREADSHEET_ID, TITLE) == GoogleSheetWriter.to_values(frame)
+
+
+def test_shorter_table_clears_leftover_rows(stand_in):
+    get_writer(stand_in).write(get_frame(5))
+    stand_in.requests.clear()
+
+    get_writer(stand_in).write(get_frame(3))
+
+    [(path, body)] = get_value_requests(stand_in)
+    assert path.endswith('/values:batchClear')
+    assert body['ranges'] == [f"'{TITLE}'!A5:C6"]
+    assert stand_in.get_rows(SPREADSHEET_ID, TITLE) == GoogleSheetWriter.to_values(get_frame(3))
+
+
+def test_quota_errors_are_retried():
+    with SheetsAPIStandIn(fail_first=2) as server:
+        frame = get_frame()
+        get_writer(server).write(frame)
+
+        assert [method for method, _, _ in server.requests[:3]] == ['GET'] * 3
+        assert server.get_rows(SPREADSHEET_ID, TITLE) == GoogleSheetWriter.to_values(frame)
+
+
+@pytest.mark.parametrize('retry_after, expected', [
+    (None, 4.), ('3', 3.), ('soon', 4.), ('-1', 0.),
+    (format_datetime(datetime(2000, 1, 1, tzinfo=timezone.utc), usegmt=True), 0.),
+])
+def test_retry_delay(retry_after, expected):
+    assert GoogleSheetWriter.get_retry_delay(retry_after, 4.) == expected
+
+
+def test_retry_delay_of_http_date():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+
+    assert 25 < GoogleSheetWriter.get_retry_delay(format_datetime(retry_at, usegmt=True), 4.) <= 30
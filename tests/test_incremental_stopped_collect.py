@@ -0,0 +1,87 @@
+import pandas as pd
+import pytest
+
+from config.definitions import CollectFields
+from processor.extractor.extractor import CollectOperationExtractor
+from processor.indicator.incremental_stopped_collect import IncrementalStoppedCollectDetector
+from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.transformer.collect_transformer import CollectTransformer
+
+
+@pytest.fixture(scope='module')
+def collect_files():
+    """Collects of each bundled file, in the order of the files"""
+    extractor = CollectOperationExtractor()
+    return [(path, CollectTransformer().load_and_transform_files(extractor, paths=[path]))
+            for path in extractor.get_collect_files()]
+
+
+@pytest.mark.parametrize('last_active_day_treshold', [0, 3, 12])
+def test_fold_matches_full_recompute(tmp_path, collect_files, last_active_day_treshold):
+    detector = IncrementalStoppedCollectDetector(last_active_day_treshold=last_active_day_treshold, path=tmp_path)
+    for path, collects in collect_files:
+        detector.fold(collects, [path])
+        # The state saved by a run is read back by the next one
+        detector.save()
+        detector = IncrementalStoppedCollectDetector(last_active_day_treshold=last_active_day_treshold, path=tmp_path)
+
+    all_collects = CollectTransformer.concat([collects for _, collects in collect_files])
+    expected = StoppedCollectDetector.get_candidate_single_pass(all_collects, 2, last_active_day_treshold)
+    pd.testing.assert_frame_equal(detector.get_candidates(), expected, check_categorical=False)
+
+
+def test_fold_keeps_integer_ids(tmp_path, collect_files):
+    detector = IncrementalStoppedCollectDetector(last_active_day_treshold=3, path=tmp_path)
+    for path, collects in collect_files:
+        detector.fold(collects, [path])
+
+    candidates = detector.get_candidates()
+    assert not candidates.empty
+    for column in [CollectFields.id, CollectFields.item_scraped_count]:
+        assert candidates[column].dtype == CollectFields.DTYPES[column]
+    # Written as 60454, not 60454.0
+    assert candidates[[CollectFields.id]].to_csv(index=False).splitlines()[1:] == [
+        str(collect_id) for collect_id in candidates[CollectFields.id]]
+
+
+def get_collects(*collects):
+    """Collects of a single territory from (id, day of March 2021, item scraped count)"""
+    return CollectTransformer.flatten([{
+        'id': collect_id,
+        'territory_uid': 'FRCOMM00001',
+        'updated_at': f'2021-03-{day:02d}T01:00:00',
+        'website': 'https://www.territory-1.fr',
+        'status': 'success',
+        'infos': {'stats': {'item_scraped_count': item_scraped_count, 'finish_reason': 'finished'}},
+    } for collect_id, day, item_scraped_count in collects])
+
+
+@pytest.mark.parametrize('folds', [
+    # A newer version of the last collect
+    [[(1, 1, 50), (2, 10, 0)], [(2, 11, 0), (3, 20, 0)]],
+    # The same collect in two overlapping exports
+    [[(1, 1, 50), (2, 10, 0)], [(2, 10, 0), (3, 20, 0)]],
+    # A newer version of an active collect before the stopped run
+    [[(1, 1, 50), (2, 10, 0)], [(1, 15, 60), (3, 20, 0)]],
+    # A newer version of the first collect of a longer stopped run
+    [[(1, 1, 50), (2, 10, 0), (4, 12, 0)], [(2, 15, 0), (3, 30, 0)]],
+    # A newer version of the only active collect, not active anymore
+    [[(1, 1, 50), (2, 10, 0)], [(1, 15, 0), (3, 30, 0)]],
+    # A collect older than the last folded one
+    [[(1, 1, 50), (2, 10, 0)], [(3, 5, 0), (4, 20, 0)]],
+])
+@pytest.mark.parametrize('minimal_collect_count', [2, 4])
+@pytest.mark.parametrize('last_active_day_treshold', [1, 12])
+def test_fold_matches_full_recompute_of_the_union(tmp_path, folds, minimal_collect_count, last_active_day_treshold):
+    detector = IncrementalStoppedCollectDetector(minimal_collect_count, last_active_day_treshold, path=tmp_path)
+    for collects in folds:
+        detector.fold(get_collects(*collects))
+        detector.save()
+        detector = IncrementalStoppedCollectDetector(minimal_collect_count, last_active_day_treshold, path=tmp_path)
+
+    all_collects = CollectTransformer.deduplicate(CollectTransformer.concat(
+        [get_collects(*collects) for collects in folds]))
+    expected = StoppedCollectDetector.get_candidate_single_pass(all_collects, minimal_collect_count,
+                                                                last_active_day_treshold)
+    assert detector.state['collect_count'].tolist() == [len(all_collects)]
+    pd.testing.assert_frame_equal(detector.get_candidates(), expected, check_categorical=False)
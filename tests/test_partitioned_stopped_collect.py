@@ -0,0 +1,49 @@
+import copy
+import json
+import shutil
+
+import pandas as pd
+import pytest
+
+from config.definitions import CollectFields
+from processor.extractor.extractor import CollectOperationExtractor
+from processor.indicator.partitioned_stopped_collect import PartitionedStoppedCollectDetector
+from processor.indicator.stopped_collect import StoppedCollectDetector
+from processor.transformer.collect_transformer import CollectTransformer
+
+
+@pytest.fixture(scope='module')
+def data_path(tmp_path_factory, collects):
+    """Bundled data, followed by an export holding again the last collects of territories, with no item scraped"""
+    data_path = tmp_path_factory.mktemp('data')
+    paths = CollectOperationExtractor().get_collect_files()
+    for path in paths:
+        shutil.copy(path, data_path / path.name)
+
+    last_collects = collects.sort_values(CollectFields.updated_at, kind='mergesort').drop_duplicates(
+        CollectFields.territory_uid, keep='last')
+    last_ids = set(last_collects.loc[last_collects[CollectFields.item_scraped_count] > 0, CollectFields.id])
+    raw_collects = [copy.deepcopy(collect) for batch in CollectOperationExtractor.iter_file_batches(paths[-1])
+                    for collect in batch if collect['id'] in last_ids]
+    for collect in raw_collects:
+        collect['infos']['stats'][CollectFields.item_scraped_count] = 0
+    (data_path / 'collect_operation_from_2021-03-15_to_2021-03-16.json').write_text(json.dumps(raw_collects))
+    return data_path
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('last_active_day_treshold', [0, 3])
+def test_partitions_match_single_pass(tmp_path, data_path, workers, last_active_day_treshold):
+    extractor = CollectOperationExtractor(data_path)
+    detector = PartitionedStoppedCollectDetector(4, 2, last_active_day_treshold, tmp_path / 'partitions')
+
+    collects = CollectTransformer().load_and_transform_files(extractor)
+    # Each collect is spilled as many times as it is exported, partitions keep its last version
+    assert detector.spill(extractor, batch_size=500, workers=workers) > len(collects)
+    assert all(len(list(detector.get_partition_path(partition).glob('*.parquet'))) > 1 for partition in range(4))
+
+    expected = StoppedCollectDetector.get_candidate_single_pass(collects, 2, last_active_day_treshold)
+    # The export of collects already spilled must change the candidates for the comparison to be meaningful
+    assert not expected.equals(StoppedCollectDetector.get_candidate_single_pass(
+        CollectTransformer().load_and_transform_files(CollectOperationExtractor()), 2, last_active_day_treshold))
+    pd.testing.assert_frame_equal(detector.get_candidates(workers), expected, check_categorical=False)
@@ -0,0 +1,30 @@
+import pandas as pd
+
+from processor.monitoring.stage_recorder import StageRecorder
+
+
+def test_run_counts_rows_of_first_argument():
+    recorder = StageRecorder(enabled=True)
+    frame = pd.DataFrame({'value': range(5)})
+
+    result = recorder.run('head', lambda dataframe, n: dataframe.head(n), frame, 2)
+
+    assert len(result) == 2
+    assert (recorder.records[0]['rows_in'], recorder.records[0]['rows_out']) == (5, 2)
+
+
+def test_run_takes_explicit_rows_in():
+    recorder = StageRecorder(enabled=True)
+    uids, frame = pd.Series(['a']), pd.DataFrame({'uid': ['a', 'b', 'a']})
+
+    result = recorder.run('filter', lambda uids, dataframe: dataframe[dataframe['uid'].isin(uids)], uids, frame,
+                          rows_in=len(frame))
+
+    assert (recorder.records[0]['rows_in'], recorder.records[0]['rows_out']) == (3, len(result))
+
+
+def test_disabled_run_is_a_plain_call():
+    recorder = StageRecorder()
+
+    assert recorder.run('sum', sum, [1, 2], rows_in=2) == 3
+    assert recorder.records == []
@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+
+from processor.indicator.stopped_collect import Engines, StoppedCollectDetector
+
+
+@pytest.mark.parametrize('last_active_day_treshold', [0, 3, 12])
+def test_engines_match_apply(collects, last_active_day_treshold):
+    reference = StoppedCollectDetector(collects.copy(), 2, last_active_day_treshold, Engines.apply,
+                                       keep_intermediate=True)
+    for engine in [engine for engine in Engines.ALL if engine != Engines.apply]:
+        detector = StoppedCollectDetector(collects.copy(), 2, last_active_day_treshold, engine,
+                                          keep_intermediate=True)
+        for step in StoppedCollectDetector.STEPS:
+            expected, result = getattr(reference, step), getattr(detector, step)
+            if isinstance(expected, pd.Series):
+                pd.testing.assert_series_equal(result, expected, obj=f'{engine} {step}')
+            else:
+                pd.testing.assert_frame_equal(result, expected, obj=f'{engine} {step}')
+
+
+@pytest.mark.parametrize('last_active_day_treshold', [0, 3, 12])
+def test_single_pass_matches_apply(collects, last_active_day_treshold):
+    reference = StoppedCollectDetector(collects.copy(), 2, last_active_day_treshold, Engines.apply,
+                                       keep_intermediate=True)
+    single_pass = StoppedCollectDetector(collects.copy(), 2, last_active_day_treshold)
+
+    pd.testing.assert_frame_equal(single_pass.candidates, reference.candidates.reset_index(drop=True))
+
+
+def test_bundled_data_has_candidates(collects):
+    # Thresholds of the parity tests above must leave candidates to compare
+    assert len(StoppedCollectDetector.get_candidate_single_pass(collects, 2, 0)) == 86
+    assert len(StoppedCollectDetector.get_candidate_single_pass(collects, 2, 3)) == 7
+
+
+def test_sweep_slices_match_single_pass(collects):
+    minimal_collect_counts, last_active_day_tresholds = [1, 2, 4], [0, 3, 12]
+    sweep = StoppedCollectDetector.sweep_candidates(collects, minimal_collect_counts,
+                                                    last_active_day_tresholds=last_active_day_tresholds)
+
+    for minimal_collect_count in minimal_collect_counts:
+        for last_active_day_treshold in last_active_day_tresholds:
+            candidates = sweep[(sweep['minimal_collect_count'] == minimal_collect_count) &
+                               (sweep['active_item_treshold'] == StoppedCollectDetector.ACTIVE_ITEM_SCRAPED_COUNT) &
+                               (sweep['last_active_day_treshold'] == last_active_day_treshold)]
+            expected = StoppedCollectDetector.get_candidate_single_pass(collects, minimal_collect_count,
+                                                                        last_active_day_treshold)
+            pd.testing.assert_frame_equal(
+                candidates.drop(columns=StoppedCollectDetector.SWEEP_COLUMNS).reset_index(drop=True), expected,
+                check_dtype=False)